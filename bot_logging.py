@@ -0,0 +1,154 @@
+import contextvars
+import json
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+import telebot
+
+# Неблокирующее логирование: вызывающий поток только кладет запись в
+# ограниченную очередь, форматирование и запись в файл делает один поток-слушатель.
+# Если очередь полна (диск не успевает), запись отбрасывается и учитывается
+# в dropped, а при первой возможности в лог уходит сообщение о потерях
+
+LOG_QUEUE_SIZE = 10000
+
+# Контекст запроса: (чат, пользователь, update_id) текущего апдейта. Его один раз
+# на апдейт выставляет ContextTeleBot, а ContextFilter переносит в каждую запись,
+# так что вызовам логгера не нужно передавать extra. Вне апдейта — SYSTEM
+SYSTEM_CONTEXT = ('SYSTEM', 'SYSTEM', '-')
+request_context = contextvars.ContextVar('request_context', default=SYSTEM_CONTEXT)
+
+def bind(chat_id, user='SYSTEM', update_id='-'):
+    return request_context.set((chat_id, user, update_id))
+
+@contextmanager
+def bound(chat_id, user='SYSTEM', update_id='-'):
+    token = bind(chat_id, user, update_id)
+    try:
+        yield
+    finally:
+        request_context.reset(token)
+
+# Фильтр стоит на обработчике очереди и выполняется в вызывающем потоке,
+# где контекст еще виден; записи ниже уровня логгера до него не доходят
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.chat_id, record.username, record.update_id = request_context.get()
+        return True
+
+# Одна запись — одна компактная JSON-строка (LOG_FORMAT=json)
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'func': record.funcName,
+            'chat': record.chat_id,
+            'user': record.username,
+            'update': record.update_id,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+        self.listener = None
+
+    # Стандартный prepare() форматирует сообщение в вызывающем потоке;
+    # здесь запись передается как есть, % подставит слушатель
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        if self.dropped != self._reported:
+            with self._lock:
+                lost, self._reported = self.dropped - self._reported, self.dropped
+            try:
+                self.queue.put_nowait(self._drop_record(record, lost))
+            except queue.Full:
+                with self._lock:
+                    self._reported -= lost
+
+    def _drop_record(self, record, lost):
+        return logging.makeLogRecord({
+            'name': record.name,
+            'levelno': logging.WARNING,
+            'levelname': logging.getLevelName(logging.WARNING),
+            'funcName': 'enqueue',
+            'msg': 'Очередь логов переполнена, потеряно записей: %d',
+            'args': (lost,),
+            'chat_id': SYSTEM_CONTEXT[0],
+            'username': SYSTEM_CONTEXT[1],
+            'update_id': SYSTEM_CONTEXT[2],
+        })
+
+    def depth(self):
+        return self.queue.qsize()
+
+    # logging.shutdown() при выходе закрывает обработчики; остановка слушателя
+    # дописывает оставшиеся в очереди записи
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+        super().close()
+
+def install(logger, *handlers, maxsize=LOG_QUEUE_SIZE):
+    queue_handler = DroppingQueueHandler(maxsize)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    queue_handler.listener.start()
+    logger.addHandler(queue_handler)
+    return queue_handler
+
+def update_context(obj):
+    chat = getattr(obj, 'chat', None) or getattr(getattr(obj, 'message', None), 'chat', None)
+    user = getattr(obj, 'from_user', None)
+    if chat is None:
+        return None
+    name = (user.username or user.first_name) if user is not None else 'SYSTEM'
+    return chat.id, name, getattr(obj, 'update_id', '-')
+
+def _bound_task(task, context):
+    def run(*args, **kwargs):
+        token = request_context.set(context)
+        try:
+            return task(*args, **kwargs)
+        finally:
+            request_context.reset(token)
+    return run
+
+# TeleBot, который выставляет контекст логов для каждого апдейта. Обработчики
+# выполняются в пуле потоков telebot, куда contextvars не переходят, поэтому
+# контекст привязывается к самой задаче пула (_exec_task), а update_id
+# заранее проставляется сообщениям и callback-запросам апдейта
+UPDATE_FIELDS = ('message', 'edited_message', 'callback_query')
+
+class ContextTeleBot(telebot.TeleBot):
+    def process_new_updates(self, updates):
+        for update in updates:
+            for field in UPDATE_FIELDS:
+                obj = getattr(update, field, None)
+                if obj is not None:
+                    obj.update_id = update.update_id
+        super().process_new_updates(updates)
+
+    def _exec_task(self, task, *args, **kwargs):
+        context = update_context(args[0]) if args else None
+        if context is not None:
+            task = _bound_task(task, context)
+        super()._exec_task(task, *args, **kwargs)
@@ -1,17 +1,33 @@
-import telebot
-from telebot import types
-import sqlite3
+from telebot import types, apihelper
 import threading
 import time
-from datetime import datetime, timedelta
+import heapq
+import random
+import queue
+from concurrent.futures import Future, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime
 import os
+import sys
+import socket
 import logging
 from logging.handlers import RotatingFileHandler
 import pytz
-from dateutil.relativedelta import relativedelta
+import requests
+from telebot.apihelper import ApiTelegramException
+from dateutil.rrule import rrule, rrulestr, HOURLY
+from functools import lru_cache
+from collections import OrderedDict
+import schema
+import storage
+import state_storage
+import bot_logging
+import metrics
+import delivery_stats
+import handler_timing
 
-# Настройка часового пояса
-TIMEZONE = pytz.timezone('Europe/Moscow')
+# Часовой пояс по умолчанию; у каждого чата может быть свой (см. chat_settings)
+TIMEZONE = pytz.timezone(schema.DEFAULT_TIMEZONE)
 
 # Настройка логирования
 def setup_logger():
@@ -20,10 +36,15 @@ def setup_logger():
 
     os.makedirs('logs', exist_ok=True)
 
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - [%(funcName)s] - ChatID: %(chat_id)s - User: %(username)s - Reminder: "%(reminder_text)s" - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    # Чат, пользователь и update_id берутся из контекста апдейта (bot_logging.request_context);
+    # LOG_FORMAT=json пишет по одной JSON-строке на запись
+    if os.getenv('LOG_FORMAT', 'text') == 'json':
+        formatter = bot_logging.JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - [%(funcName)s] - ChatID: %(chat_id)s - User: %(username)s - Update: %(update_id)s - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
 
     file_handler = RotatingFileHandler(
         'logs/bot.log',
@@ -32,60 +53,343 @@ def setup_logger():
         encoding='utf-8'
     )
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    # Файл пишет поток-слушатель; обработчики и планировщик только ставят запись в очередь
+    log_queue = bot_logging.install(logger, file_handler)
 
-    return logger
+    return logger, log_queue
 
-logger = setup_logger()
+logger, log_queue = setup_logger()
 
 # Инициализация бота
 try:
-    bot = telebot.TeleBot(os.getenv('TELEGRAM_TOKEN'))
-    logger.info("Бот инициализирован", 
-               extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
+    # Обработчики выполняются в пуле потоков; чем их больше, тем больше
+    # записей успевает попасть в один групповой коммит
+    num_threads = int(os.getenv('BOT_THREADS', '8'))
+    # HANDLER_TIMING=1: замер фильтров и обработчиков, медленнее SLOW_HANDLER_MS — в лог
+    if os.getenv('HANDLER_TIMING', '0') == '1':
+        bot = handler_timing.TimedTeleBot(
+            os.getenv('TELEGRAM_TOKEN'), num_threads=num_threads, logger=logger,
+            slow_ms=int(os.getenv('SLOW_HANDLER_MS', str(handler_timing.SLOW_HANDLER_MS)))
+        )
+    else:
+        bot = bot_logging.ContextTeleBot(os.getenv('TELEGRAM_TOKEN'), num_threads=num_threads)
+    logger.info("Бот инициализирован")
 except Exception as e:
-    logger.error(f"Ошибка инициализации бота: {str(e)}", 
-                extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'}, 
-                exc_info=True)
+    logger.error("Ошибка инициализации бота: %s", e, exc_info=True)
     exit()
 
 # Инициализация БД
+# Число шардов базы: чат живет в файле chat_id % DB_SHARDS. При 1 используется
+# прежний reminders.db, при N > 1 — reminders.0.db ... reminders.N-1.db.
+# Готового переноса между раскладками нет: reminders_io.py переносит только
+# таблицу reminders, а часовые пояса чатов (chat_settings) при этом теряются
+DB_SHARDS = int(os.getenv('DB_SHARDS', '1'))
+
 def init_db():
     try:
-        conn = sqlite3.connect('reminders.db', timeout=30, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reminders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            text TEXT NOT NULL,
-            time TEXT NOT NULL,
-            is_active BOOLEAN DEFAULT 1,
-            repeat_interval TEXT,
-            next_time TEXT NOT NULL
-        )
-        ''')
-        
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_id ON reminders(chat_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_next_time ON reminders(next_time)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_active ON reminders(is_active)')
-        
-        conn.commit()
-        logger.info("База данных инициализирована", 
-                   extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
-        return conn, cursor
+        store = storage.ShardedStore(storage.shard_paths('reminders.db', DB_SHARDS))
+        # Схема ведется версионными миграциями (schema.MIGRATIONS); долгие шаги
+        # идут короткими транзакциями, так что другие процессы бота не стоят
+        for shard, db in enumerate(store.databases):
+            conn = db.connection()
+            for version, name, elapsed in schema.migrate(conn):
+                logger.info("Шард %s: применена миграция %s (%s) за %.1f с", shard, version, name, elapsed)
+            backfilled = schema.backfill_text_only(conn)
+            if backfilled:
+                logger.warning("Шард %s: дописан next_ts строкам без него: %s", shard, backfilled)
+            for name, detail in schema.check_query_plans(conn):
+                logger.warning("Шард %s: план запроса %s без индекса: %s", shard, name, detail)
+        logger.info("База данных инициализирована, шардов: %s", len(store))
+        return store
     except Exception as e:
-        logger.error(f"Ошибка базы данных: {str(e)}", 
-                    extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка базы данных: %s", e, exc_info=True)
         exit()
 
-conn, cursor = init_db()
+store = init_db()
+
+# Записи из обработчиков идут через поток-писатель своего шарда (групповой коммит);
+# обработчик ждет свою операцию не дольше WRITE_TIMEOUT
+WRITE_TIMEOUT = 10
+
+# Часовые пояса чатов. Все сроки хранятся и сравниваются в UTC, местное время
+# нужно только для разбора ввода, показа и повторов по «часам на стене»
+CHAT_TZ_CACHE_SIZE = 100000
+TIMEZONE_NAMES = {name.lower(): name for name in pytz.common_timezones}
+TIMEZONE_CHOICES = [
+    ("Калининград", 'Europe/Kaliningrad'),
+    ("Москва", 'Europe/Moscow'),
+    ("Самара", 'Europe/Samara'),
+    ("Екатеринбург", 'Asia/Yekaterinburg'),
+    ("Омск", 'Asia/Omsk'),
+    ("Новосибирск", 'Asia/Novosibirsk'),
+    ("Иркутск", 'Asia/Irkutsk'),
+    ("Владивосток", 'Asia/Vladivostok'),
+]
+chat_timezones = OrderedDict()
+chat_timezones_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    return pytz.timezone(name)
+
+def remember_chat_timezone(chat_id, name):
+    with chat_timezones_lock:
+        chat_timezones[chat_id] = name
+        chat_timezones.move_to_end(chat_id)
+        if len(chat_timezones) > CHAT_TZ_CACHE_SIZE:
+            chat_timezones.popitem(last=False)
+
+def get_chat_timezone(chat_id):
+    with chat_timezones_lock:
+        name = chat_timezones.get(chat_id)
+        if name is not None:
+            chat_timezones.move_to_end(chat_id)
+    if name is None:
+        row = store.db(chat_id).query_one(
+            'SELECT timezone FROM chat_settings WHERE chat_id = ?',
+            (chat_id,)
+        )
+        name = row[0] if row else schema.DEFAULT_TIMEZONE
+        remember_chat_timezone(chat_id, name)
+    return get_timezone(name)
+
+def set_chat_timezone(chat_id, name):
+    store.writes(chat_id).execute(
+        '''INSERT INTO chat_settings(chat_id, timezone) VALUES (?, ?)
+           ON CONFLICT(chat_id) DO UPDATE SET timezone = excluded.timezone''',
+        (chat_id, name)
+    ).result(WRITE_TIMEOUT)
+    remember_chat_timezone(chat_id, name)
+    listing_cache.invalidate(chat_id)
+
+# Планировщик напоминаний: min-heap по времени срабатывания вместо опроса таблицы
+# Повтор после ошибки отправки: экспоненциальная задержка со случайным разбросом.
+# Постоянные ошибки (бот заблокирован, чат удален) сразу уводят напоминание в dead letter
+RETRY_DELAY = 30  # базовая задержка, сек
+RETRY_MAX_DELAY = 3600
+MAX_SEND_ATTEMPTS = 8
+CHAT_GONE_ERRORS = {'forbidden', 'chat_not_found'}
+PERMANENT_ERRORS = CHAT_GONE_ERRORS | {'bad_request'}
+
+# Несколько процессов делят таблицу через аренду: строка забирается атомарным
+# UPDATE ... RETURNING, а просроченная аренда снова становится доступной
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+CLAIM_BATCH_SIZE = 500
+LEASE_SECONDS = 300
+# Как часто перечитывать таблицу, даже если в своей куче нет сроков:
+# так подхватываются напоминания других процессов и брошенные аренды
+RESYNC_INTERVAL = int(os.getenv('RESYNC_INTERVAL', '300'))
+# Процесс --scheduler-only сам напоминаний не создает и о новых строках узнает,
+# раз в SCHEDULER_POLL_INTERVAL спрашивая у каждого шарда ближайший незахваченный срок
+SCHEDULER_ONLY = '--scheduler-only' in sys.argv
+SCHEDULER_POLL_INTERVAL = int(os.getenv('SCHEDULER_POLL_INTERVAL', '5'))
+
+# Догоняющий режим после простоя: повторяющееся напоминание сразу переносится
+# на первый срок в будущем, а пропущенные повторы обрабатываются по политике:
+# skip — не присылать устаревшие, coalesce — одно сообщение «пропущено N», all — все
+CATCHUP_POLICY = os.getenv('CATCHUP_POLICY', 'coalesce')
+CATCHUP_GRACE = 300  # опоздание в секундах, которое еще не считается пропуском
+# all шлет не больше стольких сообщений в чат за раз, дальше — одно сводное:
+# длинная серия упиралась бы в лимит Telegram на чат (429 и повтор с начала)
+# и держала бы отправку дольше аренды
+CATCHUP_MAX_MESSAGES = int(os.getenv('CATCHUP_MAX_MESSAGES', '5'))
+
+# Повторы хранятся в repeat_interval как правила RRULE (RFC 5545)
+# и вычисляются через dateutil.rrule в местном времени
+REPEAT_RULES = {
+    'daily': ("Ежедневно", 'FREQ=DAILY'),
+    'weekly': ("Еженедельно", 'FREQ=WEEKLY'),
+    'monthly': ("Ежемесячно", 'FREQ=MONTHLY'),
+    'weekdays': ("По будням", 'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR'),
+    'lastfri': ("Последняя пятница месяца", 'FREQ=MONTHLY;BYDAY=-1FR'),
+}
+RULE_LABELS = {rule: label for label, rule in REPEAT_RULES.values()}
+RULE_DTSTART = datetime(2000, 1, 1)  # заменяется временем конкретного напоминания
+
+# Разобранные правила кешируются по тексту, планировщик не парсит строку при каждой отправке
+@lru_cache(maxsize=1024)
+def compile_rule(rule_text):
+    if rule_text in REPEAT_RULES:  # старые значения daily/weekly/monthly
+        rule_text = REPEAT_RULES[rule_text][1]
+    rule = rrulestr(rule_text, dtstart=RULE_DTSTART)
+    # INTERVAL=0 зацикливает dateutil навсегда
+    if not isinstance(rule, rrule) or rule._freq > HOURLY or rule._interval < 1:
+        raise ValueError(f"Неподдерживаемое правило повтора: {rule_text}")
+    return rule
+
+# Правило, которое никогда не срабатывает (FREQ=HOURLY;BYMONTH=2;BYMONTHDAY=30),
+# dateutil ищет до 9999 года — секунды на каждую строку в потоке планировщика.
+# Поэтому правило пользователя принимается, только если ближайший срок
+# находится за RULE_CHECK_TIMEOUT. Проверка идет в отдельном потоке: зависшая
+# доработает в фоне, а одновременно таких потоков не больше RULE_CHECK_THREADS
+RULE_CHECK_TIMEOUT = 1  # сек
+RULE_CHECK_THREADS = 4
+rule_check_slots = threading.BoundedSemaphore(RULE_CHECK_THREADS)
+
+def next_occurrence(rule_text, next_ts, tz):
+    start = datetime.fromtimestamp(next_ts, tz).replace(tzinfo=None)
+    return compile_rule(rule_text).replace(dtstart=start).after(start)
+
+def validate_rule(rule_text, next_ts, tz):
+    compile_rule(rule_text)
+    if not rule_check_slots.acquire(blocking=False):
+        raise ValueError("Слишком много одновременных проверок правил")
+    result = Future()
+
+    def check():
+        try:
+            result.set_result(next_occurrence(rule_text, next_ts, tz))
+        except Exception as e:
+            result.set_exception(e)
+        finally:
+            rule_check_slots.release()
+
+    threading.Thread(target=check, name='rule-check', daemon=True).start()
+    try:
+        following = result.result(RULE_CHECK_TIMEOUT)
+    except FutureTimeoutError:
+        raise ValueError(f"Слишком долгий поиск срока по правилу: {rule_text}")
+    if following is None:
+        raise ValueError(f"У правила нет следующих сроков: {rule_text}")
+
+def build_repeat_rule(key, next_ts, tz):
+    rule = REPEAT_RULES[key][1]
+    day = datetime.fromtimestamp(next_ts, tz).day
+    if key == 'monthly' and day > 28:
+        # По RFC 5545 месяцы без 29-31 числа пропускаются; прижимаем к последнему дню
+        rule = f'FREQ=MONTHLY;BYMONTHDAY={day},-1;BYSETPOS=1'
+    return rule
 
-# Состояния пользователей
-user_states = {}
+def describe_rule(rule_text):
+    if rule_text in REPEAT_RULES:
+        return REPEAT_RULES[rule_text][0]
+    if rule_text.startswith('FREQ=MONTHLY;BYMONTHDAY='):
+        return "Ежемесячно"
+    return RULE_LABELS.get(rule_text, rule_text)
+
+# Ключ в куче — (шард, id): id напоминаний уникальны только внутри шарда,
+# а одна куча сводит сроки всех шардов
+class ReminderScheduler:
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+
+    def load(self):
+        shards = [(shard, db.query(schema.SQL_LOAD_ACTIVE)) for shard, db in enumerate(store.databases)]
+        with self._cond:
+            self._heap = []
+            self._deadlines = {}
+            for shard, rows in shards:
+                for reminder_id, next_ts in rows:
+                    self._push((shard, reminder_id), next_ts)
+            self._cond.notify()
+        return sum(len(rows) for shard, rows in shards)
+
+    def _push(self, key, deadline):
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        # Отмененные записи удаляются из кучи лениво, не даем им копиться
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, i) for i, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def schedule(self, key, deadline):
+        with self._cond:
+            self._push(key, deadline)
+            if self._heap[0] == (deadline, key):
+                self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def refresh(self, key):
+        row = store.databases[key[0]].query_one(schema.SQL_ACTIVE_NEXT_TS, (key[1],))
+        if row:
+            self.schedule(key, row[0])
+        else:
+            self.cancel(key)
+
+    def wait_due(self, max_wait):
+        # Спим до ближайшего срока (но не дольше max_wait); schedule() будит поток,
+        # если срок сдвинулся раньше
+        wake_at = time.time() + max_wait
+        with self._cond:
+            while True:
+                while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                now = time.time()
+                if (self._heap and self._heap[0][0] <= now) or now >= wake_at:
+                    break
+                self._cond.wait(min(self._heap[0][0], wake_at) - now if self._heap else wake_at - now)
+
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, reminder_id = heapq.heappop(self._heap)
+                if self._deadlines.get(reminder_id) == deadline:
+                    del self._deadlines[reminder_id]
+                    due.append(reminder_id)
+            return due
+
+scheduler = ReminderScheduler()
+
+# Пул отправителей: напоминания одного чата всегда попадают в одну очередь,
+# поэтому порядок внутри чата сохраняется, а разные чаты отправляются параллельно
+SENDER_WORKERS = int(os.getenv('SENDER_WORKERS', '8'))
+SENDER_QUEUE_SIZE = 1000
+
+class DeliveryPool:
+    def __init__(self, workers, queue_size):
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        for i, q in enumerate(self._queues):
+            threading.Thread(target=self._worker, args=(q,), name=f'sender-{i}', daemon=True).start()
+
+    def submit(self, reminder, messages):
+        future = Future()
+        # put() блокируется при переполненной очереди — естественное ограничение нагрузки
+        self._queues[reminder[1] % len(self._queues)].put((reminder, messages, future))
+        return future
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _worker(self, q):
+        while True:
+            reminder, messages, future = q.get()
+            try:
+                with bot_logging.bound(reminder[1]):
+                    future.set_result(send_reminder(reminder, messages))
+            except Exception as e:
+                future.set_exception(e)
+
+delivery_pool = DeliveryPool(SENDER_WORKERS, SENDER_QUEUE_SIZE)
+
+# Состояния пользователей: хранилище telebot с TTL и LRU, копия в таблице
+# bot_states, поэтому незаконченные диалоги переживают перезапуск
+STATE_TTL = int(os.getenv('STATE_TTL', str(state_storage.STATE_TTL)))
+STATE_CACHE_SIZE = int(os.getenv('STATE_CACHE_SIZE', str(state_storage.STATE_CACHE_SIZE)))
+# bot_states хранится в шарде чата, как и его напоминания
+bot.current_states = state_storage.StateTTLStorage(store, STATE_TTL, STATE_CACHE_SIZE)
+
+def set_user_state(chat_id, user_id, state, **data):
+    bot.delete_state(user_id, chat_id)
+    bot.set_state(user_id, state, chat_id)
+    if data:
+        bot.add_data(user_id, chat_id, **data)
+
+def get_user_state(chat_id, user_id):
+    state = bot.get_state(user_id, chat_id)
+    if state is None:
+        return None, {}
+    with bot.retrieve_data(user_id, chat_id) as data:
+        return state, data
+
+def clear_user_state(chat_id, user_id):
+    bot.delete_state(user_id, chat_id)
 
 # Клавиатуры
 def create_main_keyboard():
@@ -94,7 +398,17 @@ def create_main_keyboard():
         "➕ Создать напоминание",
         "📝 Мои напоминания",
         "❌ Удалить напоминание",
-        "🔄 Настроить повтор"
+        "🔄 Настроить повтор",
+        "🌍 Часовой пояс"
+    ]
+    markup.add(*buttons)
+    return markup
+
+def create_timezone_keyboard():
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = [
+        types.InlineKeyboardButton(label, callback_data=f'tz_{name}')
+        for label, name in TIMEZONE_CHOICES
     ]
     markup.add(*buttons)
     return markup
@@ -102,9 +416,11 @@ def create_main_keyboard():
 def create_repeat_keyboard():
     markup = types.InlineKeyboardMarkup(row_width=2)
     buttons = [
-        types.InlineKeyboardButton("Ежедневно", callback_data='repeat_daily'),
-        types.InlineKeyboardButton("Еженедельно", callback_data='repeat_weekly'),
-        types.InlineKeyboardButton("Ежемесячно", callback_data='repeat_monthly'),
+        types.InlineKeyboardButton(label, callback_data=f'repeat_{key}')
+        for key, (label, rule) in REPEAT_RULES.items()
+    ]
+    buttons += [
+        types.InlineKeyboardButton("✏️ Свое правило (RRULE)", callback_data='repeat_custom'),
         types.InlineKeyboardButton("❌ Без повтора", callback_data='repeat_none')
     ]
     markup.add(*buttons)
@@ -120,7 +436,8 @@ def send_welcome(message):
             "/remind - Создать напоминание\n"
             "/my_reminders - Список напоминаний\n"
             "/del_reminder - Удалить напоминание\n"
-            "/set_repeat - Настроить повтор\n\n"
+            "/set_repeat - Настроить повтор\n"
+            "/timezone - Часовой пояс\n\n"
             "Или используйте кнопки ниже:"
         )
         bot.send_message(
@@ -129,16 +446,9 @@ def send_welcome(message):
             parse_mode='HTML',
             reply_markup=create_main_keyboard()
         )
-        logger.info("Пользователь запустил бота", 
-                   extra={'chat_id': message.chat.id, 
-                          'username': message.from_user.username or message.from_user.first_name,
-                          'reminder_text': 'N/A'})
+        logger.info("Пользователь запустил бота")
     except Exception as e:
-        logger.error(f"Ошибка в send_welcome: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка в send_welcome: %s", e, exc_info=True)
 
 @bot.message_handler(commands=['remind'])
 def handle_remind_command(message):
@@ -156,6 +466,10 @@ def handle_del_reminder_command(message):
 def handle_set_repeat_command(message):
     ask_for_repeat_id(message)
 
+@bot.message_handler(commands=['timezone'])
+def handle_timezone_command(message):
+    ask_for_timezone(message)
+
 # Обработчики кнопок
 @bot.message_handler(func=lambda m: m.text in ["➕ Создать напоминание", "Создать напоминание"])
 def handle_create_button(message):
@@ -173,10 +487,14 @@ def handle_delete_button(message):
 def handle_repeat_button(message):
     ask_for_repeat_id(message)
 
+@bot.message_handler(func=lambda m: m.text in ["🌍 Часовой пояс", "Часовой пояс"])
+def handle_timezone_button(message):
+    ask_for_timezone(message)
+
 # Основные функции
 def ask_for_reminder(message):
     try:
-        user_states[message.chat.id] = {'state': 'waiting_for_reminder'}
+        set_user_state(message.chat.id, message.from_user.id, 'waiting_for_reminder')
         bot.send_message(
             message.chat.id,
             "📝 Введите напоминание в формате:\n"
@@ -186,16 +504,16 @@ def ask_for_reminder(message):
             parse_mode='HTML',
             reply_markup=types.ReplyKeyboardRemove()
         )
-        logger.info("Запрос на создание напоминания", 
-                   extra={'chat_id': message.chat.id, 
-                          'username': message.from_user.username or message.from_user.first_name,
-                          'reminder_text': 'N/A'})
+        logger.info("Запрос на создание напоминания")
     except Exception as e:
-        logger.error(f"Ошибка в ask_for_reminder: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка в ask_for_reminder: %s", e, exc_info=True)
+
+# Сводка чата из chat_agenda (ведется триггерами): одна строка по ключу
+# вместо подсчета напоминаний. 0 — без ограничения числа активных напоминаний
+MAX_ACTIVE_REMINDERS = int(os.getenv('MAX_ACTIVE_REMINDERS', '0'))
+
+def get_chat_agenda(chat_id):
+    return store.db(chat_id).query_one(schema.SQL_CHAT_AGENDA, (chat_id,)) or (0, None, None)
 
 def process_reminder(message):
     try:
@@ -205,33 +523,46 @@ def process_reminder(message):
             
         date_str, time_str, text = parts
         
-        # Парсим время с учетом часового пояса
+        # Парсим время в часовом поясе чата
         naive_datetime = datetime.strptime(f"{date_str} {time_str}", "%d.%m.%Y %H:%M")
-        local_datetime = TIMEZONE.localize(naive_datetime, is_dst=None)
-        formatted_time = local_datetime.strftime("%Y-%m-%d %H:%M")
+        local_datetime = get_chat_timezone(message.chat.id).localize(naive_datetime)
+        formatted_time = local_datetime.astimezone(TIMEZONE).strftime("%Y-%m-%d %H:%M")
+        timestamp = int(local_datetime.timestamp())
+        
+        if MAX_ACTIVE_REMINDERS and get_chat_agenda(message.chat.id)[0] >= MAX_ACTIVE_REMINDERS:
+            bot.send_message(
+                message.chat.id,
+                f"❌ Достигнут лимит активных напоминаний: <b>{MAX_ACTIVE_REMINDERS}</b>\n"
+                "Удалите ненужные, чтобы создать новое.",
+                parse_mode='HTML',
+                reply_markup=create_main_keyboard()
+            )
+            logger.warning("Превышен лимит активных напоминаний, текст: '%s'", text)
+            return
         
-        cursor.execute(
-            'INSERT INTO reminders(chat_id, username, text, time, next_time) VALUES (?, ?, ?, ?, ?)',
+        reminder_id, _ = store.writes(message.chat.id).execute(
+            '''INSERT INTO reminders(chat_id, username, text, time, next_time, time_ts, next_ts)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
             (message.chat.id, 
              message.from_user.username or message.from_user.first_name, 
              text, 
              formatted_time, 
-             formatted_time)
-        )
-        conn.commit()
+             formatted_time,
+             timestamp,
+             timestamp)
+        ).result(WRITE_TIMEOUT)
+        scheduler.schedule((store.shard(message.chat.id), reminder_id), timestamp)
+        listing_cache.invalidate(message.chat.id)
         
         logger.info(
-            f"Создано напоминание: Дата='{date_str} {time_str}', Текст='{text}', ID={cursor.lastrowid}",
-            extra={'chat_id': message.chat.id, 
-                   'username': message.from_user.username or message.from_user.first_name,
-                   'reminder_text': text}
+            "Создано напоминание: Дата='%s %s', Текст='%s', ID=%s", date_str, time_str, text, reminder_id
         )
         
         response = (
             f"✅ <b>Напоминание создано!</b>\n\n"
             f"📅 <b>Дата:</b> {date_str} {time_str}\n"
             f"📝 <b>Текст:</b> {text}\n\n"
-            f"ID: {cursor.lastrowid}"
+            f"ID: {reminder_id}"
         )
         
         bot.send_message(
@@ -248,36 +579,157 @@ def process_reminder(message):
             parse_mode='HTML',
             reply_markup=create_main_keyboard()
         )
-        logger.warning("Некорректный формат напоминания", 
-                     extra={'chat_id': message.chat.id, 
-                            'username': message.from_user.username or message.from_user.first_name,
-                            'reminder_text': 'N/A'})
+        logger.warning("Некорректный формат напоминания")
     except Exception as e:
-        logger.error(f"Ошибка создания напоминания: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка создания напоминания: %s", e, exc_info=True)
         bot.send_message(
             message.chat.id,
             "❌ Произошла ошибка при создании напоминания",
             reply_markup=create_main_keyboard()
         )
     finally:
-        user_states.pop(message.chat.id, None)
+        clear_user_state(message.chat.id, message.from_user.id)
+
+# Список напоминаний постранично: курсор страницы — (next_ts, id) ее первой
+# или последней строки, поэтому стоимость запроса и размер сообщения
+# не зависят от общего числа напоминаний
+LISTING_PAGE_SIZE = 20
+LISTING_TEXT_LIMIT = 150  # длинные тексты обрезаются
+LISTING_RULE_LIMIT = 60  # как и подписи повтора (произвольный RRULE может быть длинным)
+# Страница собирается по бюджету символов с запасом до 4096 у Telegram: строки,
+# которые в него не влезли, уходят на следующую страницу
+LISTING_CHAR_BUDGET = 4000
+FIRST_PAGE_CURSOR = (-1, -1)
+
+# Кэш отрисованных страниц списка: ключ — (chat_id, курсор, направление).
+# Любая запись в напоминания чата сбрасывает все его страницы; поколение чата
+# не дает сохранить страницу, прочитанную до записи, а закончившуюся после нее.
+# TTL страхует от изменений, сделанных другим процессом (--scheduler-only)
+LISTING_CACHE_SIZE = 5000
+LISTING_CACHE_TTL = 60
+
+class ListingCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+        self._chat_keys = {}
+        self._generations = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._pages.move_to_end(key)
+                self.hits += 1
+                return entry[1], None
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None, self._generations.get(key[0])
+
+    def put(self, key, generation, page):
+        with self._lock:
+            if self._generations.get(key[0]) != generation:
+                return
+            self._pages[key] = (time.monotonic() + self.ttl, page)
+            self._pages.move_to_end(key)
+            self._chat_keys.setdefault(key[0], set()).add(key)
+            while len(self._pages) > self.maxsize:
+                self._drop(next(iter(self._pages)))
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._generation += 1
+            self._generations[chat_id] = self._generation
+            self._generations.move_to_end(chat_id)
+            # поколения нужны только на время чтения, храним их с запасом
+            while len(self._generations) > self.maxsize * 4:
+                self._generations.popitem(last=False)
+            for key in self._chat_keys.pop(chat_id, ()):
+                del self._pages[key]
+
+    def _drop(self, key):
+        del self._pages[key]
+        keys = self._chat_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._chat_keys[key[0]]
+
+listing_cache = ListingCache(LISTING_CACHE_SIZE, LISTING_CACHE_TTL)
+
+def load_reminders_page(chat_id, cursor=None, backward=False):
+    if backward:
+        rows = store.db(chat_id).query(schema.SQL_CHAT_PAGE_BEFORE, (chat_id, *cursor, LISTING_PAGE_SIZE + 1))
+        has_prev = len(rows) > LISTING_PAGE_SIZE
+        rows = rows[:LISTING_PAGE_SIZE][::-1]
+        has_next = True
+    else:
+        rows = store.db(chat_id).query(schema.SQL_CHAT_PAGE, (chat_id, *(cursor or FIRST_PAGE_CURSOR), LISTING_PAGE_SIZE + 1))
+        has_next = len(rows) > LISTING_PAGE_SIZE
+        rows = rows[:LISTING_PAGE_SIZE]
+        has_prev = cursor is not None
+    return rows, has_prev, has_next
+
+def clip(text, limit):
+    return text if len(text) <= limit else text[:limit] + "…"
+
+def render_reminder_row(rem, tz):
+    formatted_time = datetime.fromtimestamp(rem[1], tz).strftime("%d.%m.%Y %H:%M")
+    repeat_info = f" (повтор: {clip(describe_rule(rem[3]), LISTING_RULE_LIMIT)})" if rem[3] else ""
+    return f"🆔 <b>{rem[0]}</b>: ⏰ {formatted_time}{repeat_info}\n✏️ {clip(rem[2], LISTING_TEXT_LIMIT)}\n\n"
+
+def render_reminders_page(chat_id, rows, has_prev, has_next, backward=False):
+    tz = get_chat_timezone(chat_id)
+    response = f"📋 <b>Ваши напоминания</b> (всего: {get_chat_agenda(chat_id)[0]}):\n\n"
+    # Строки берутся от курсора: при движении назад — с конца страницы.
+    # Не влезшие в бюджет отрезаются, и курсор кнопки берется от последней показанной
+    shown = []
+    size = len(response)
+    for rem in (reversed(rows) if backward else rows):
+        entry = render_reminder_row(rem, tz)
+        if shown and size + len(entry) > LISTING_CHAR_BUDGET:
+            if backward:
+                has_prev = True
+            else:
+                has_next = True
+            break
+        shown.append((rem, entry))
+        size += len(entry)
+    if backward:
+        shown.reverse()
+    rows = [rem for rem, entry in shown]
+    response += "".join(entry for rem, entry in shown)
+    
+    if not (has_prev or has_next):
+        return response, None
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    if has_prev:
+        buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f'page_prev_{rows[0][1]}_{rows[0][0]}'))
+    if has_next:
+        buttons.append(types.InlineKeyboardButton("Вперед ➡️", callback_data=f'page_next_{rows[-1][1]}_{rows[-1][0]}'))
+    markup.add(*buttons)
+    return response, markup
+
+def get_reminders_page(chat_id, cursor=None, backward=False):
+    key = (chat_id, cursor, backward)
+    page, generation = listing_cache.get(key)
+    if page is None:
+        rows, has_prev, has_next = load_reminders_page(chat_id, cursor, backward)
+        page = render_reminders_page(chat_id, rows, has_prev, has_next, backward) if rows else (None, None)
+        listing_cache.put(key, generation, page)
+    return page
 
 def show_reminders(message):
     try:
-        cursor.execute(
-            '''SELECT id, time, text, repeat_interval 
-               FROM reminders 
-               WHERE chat_id = ? AND is_active = 1 
-               ORDER BY time''',
-            (message.chat.id,)
-        )
-        reminders = cursor.fetchall()
+        response, markup = get_reminders_page(message.chat.id)
         
-        if not reminders:
+        if response is None:
             bot.send_message(
                 message.chat.id,
                 "📭 У вас пока нет активных напоминаний",
@@ -285,82 +737,78 @@ def show_reminders(message):
             )
             return
             
-        response = "📋 <b>Ваши напоминания:</b>\n\n"
-        for rem in reminders:
-            date_obj = datetime.strptime(rem[1], "%Y-%m-%d %H:%M")
-            formatted_time = date_obj.strftime("%d.%m.%Y %H:%M")
-            repeat_info = f" (повтор: {rem[3]})" if rem[3] else ""
-            response += f"🆔 <b>{rem[0]}</b>: ⏰ {formatted_time}{repeat_info}\n✏️ {rem[2]}\n\n"
-            
         bot.send_message(
             message.chat.id,
             response,
             parse_mode='HTML',
-            reply_markup=create_main_keyboard()
+            reply_markup=markup or create_main_keyboard()
         )
-        logger.info(f"Показаны напоминания (количество: {len(reminders)})", 
-                   extra={'chat_id': message.chat.id, 
-                          'username': message.from_user.username or message.from_user.first_name,
-                          'reminder_text': 'N/A'})
+        logger.info("Показаны напоминания (кэш: %s попаданий, %s промахов)",
+                    listing_cache.hits, listing_cache.misses)
     except Exception as e:
-        logger.error(f"Ошибка показа напоминаний: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка показа напоминаний: %s", e, exc_info=True)
         bot.send_message(
             message.chat.id,
             "❌ Ошибка при получении напоминаний",
             reply_markup=create_main_keyboard()
         )
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith('page_'))
+def handle_reminders_page(call):
+    try:
+        chat_id = call.message.chat.id
+        _, direction, next_ts, reminder_id = call.data.split('_')
+        response, markup = get_reminders_page(
+            chat_id, (int(next_ts), int(reminder_id)), backward=direction == 'prev'
+        )
+        if response is None:
+            bot.answer_callback_query(call.id, "Больше напоминаний нет")
+            return
+        
+        bot.edit_message_text(
+            response,
+            chat_id,
+            call.message.message_id,
+            parse_mode='HTML',
+            reply_markup=markup
+        )
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.error("Ошибка в handle_reminders_page: %s", e, exc_info=True)
+        bot.answer_callback_query(call.id, "❌ Произошла ошибка")
+
 def ask_for_reminder_id(message):
     try:
-        user_states[message.chat.id] = {'state': 'waiting_for_reminder_id'}
+        set_user_state(message.chat.id, message.from_user.id, 'waiting_for_reminder_id')
         bot.send_message(
             message.chat.id,
             "✏️ Введите <b>ID напоминания</b> для удаления:",
             parse_mode='HTML',
             reply_markup=types.ReplyKeyboardRemove()
         )
-        logger.info("Запрос ID для удаления напоминания", 
-                   extra={'chat_id': message.chat.id, 
-                          'username': message.from_user.username or message.from_user.first_name,
-                          'reminder_text': 'N/A'})
+        logger.info("Запрос ID для удаления напоминания")
     except Exception as e:
-        logger.error(f"Ошибка в ask_for_reminder_id: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка в ask_for_reminder_id: %s", e, exc_info=True)
 
 def delete_reminder(message):
     try:
         reminder_id = int(message.text)
-        cursor.execute(
-            'SELECT text FROM reminders WHERE id = ? AND chat_id = ?',
+        deleted = store.writes(message.chat.id).submit(lambda conn: conn.execute(
+            'DELETE FROM reminders WHERE id = ? AND chat_id = ? RETURNING text',
             (reminder_id, message.chat.id)
-        )
-        reminder_text = cursor.fetchone()
-        reminder_text = reminder_text[0] if reminder_text else 'N/A'
+        ).fetchall()).result(WRITE_TIMEOUT)
         
-        cursor.execute(
-            'DELETE FROM reminders WHERE id = ? AND chat_id = ?',
-            (reminder_id, message.chat.id)
-        )
-        conn.commit()
-        
-        if cursor.rowcount > 0:
+        if deleted:
+            reminder_text = deleted[0][0]
+            scheduler.cancel((store.shard(message.chat.id), reminder_id))
+            listing_cache.invalidate(message.chat.id)
             bot.send_message(
                 message.chat.id,
                 f"✅ Напоминание <b>{reminder_id}</b> успешно удалено!",
                 parse_mode='HTML',
                 reply_markup=create_main_keyboard()
             )
-            logger.info(f"Удалено напоминание ID: {reminder_id}", 
-                       extra={'chat_id': message.chat.id, 
-                              'username': message.from_user.username or message.from_user.first_name,
-                              'reminder_text': reminder_text})
+            logger.info("Удалено напоминание ID: %s, текст: '%s'", reminder_id, reminder_text)
         else:
             bot.send_message(
                 message.chat.id,
@@ -368,10 +816,7 @@ def delete_reminder(message):
                 parse_mode='HTML',
                 reply_markup=create_main_keyboard()
             )
-            logger.warning(f"Попытка удалить несуществующее напоминание ID: {reminder_id}", 
-                         extra={'chat_id': message.chat.id, 
-                                'username': message.from_user.username or message.from_user.first_name,
-                                'reminder_text': 'N/A'})
+            logger.warning("Попытка удалить несуществующее напоминание ID: %s", reminder_id)
     except ValueError:
         bot.send_message(
             message.chat.id,
@@ -379,52 +824,37 @@ def delete_reminder(message):
             parse_mode='HTML',
             reply_markup=create_main_keyboard()
         )
-        logger.warning("Некорректный ввод ID для удаления", 
-                     extra={'chat_id': message.chat.id, 
-                            'username': message.from_user.username or message.from_user.first_name,
-                            'reminder_text': 'N/A'})
+        logger.warning("Некорректный ввод ID для удаления")
     except Exception as e:
-        logger.error(f"Ошибка удаления напоминания: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка удаления напоминания: %s", e, exc_info=True)
         bot.send_message(
             message.chat.id,
             "❌ Ошибка при удалении напоминания",
             reply_markup=create_main_keyboard()
         )
     finally:
-        user_states.pop(message.chat.id, None)
+        clear_user_state(message.chat.id, message.from_user.id)
 
 def ask_for_repeat_id(message):
     try:
-        user_states[message.chat.id] = {'state': 'waiting_for_repeat_id'}
+        set_user_state(message.chat.id, message.from_user.id, 'waiting_for_repeat_id')
         bot.send_message(
             message.chat.id,
             "✏️ Введите <b>ID напоминания</b> для настройки повтора:",
             parse_mode='HTML',
             reply_markup=types.ReplyKeyboardRemove()
         )
-        logger.info("Запрос ID для настройки повтора", 
-                   extra={'chat_id': message.chat.id, 
-                          'username': message.from_user.username or message.from_user.first_name,
-                          'reminder_text': 'N/A'})
+        logger.info("Запрос ID для настройки повтора")
     except Exception as e:
-        logger.error(f"Ошибка в ask_for_repeat_id: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка в ask_for_repeat_id: %s", e, exc_info=True)
 
 def process_repeat_id(message):
     try:
         reminder_id = int(message.text)
-        cursor.execute(
+        reminder = store.db(message.chat.id).query_one(
             'SELECT id, text FROM reminders WHERE id = ? AND chat_id = ?',
             (reminder_id, message.chat.id)
         )
-        reminder = cursor.fetchone()
         
         if not reminder:
             bot.send_message(
@@ -433,26 +863,18 @@ def process_repeat_id(message):
                 parse_mode='HTML',
                 reply_markup=create_main_keyboard()
             )
-            logger.warning(f"Попытка настроить повтор для несуществующего напоминания ID: {reminder_id}", 
-                         extra={'chat_id': message.chat.id, 
-                                'username': message.from_user.username or message.from_user.first_name,
-                                'reminder_text': 'N/A'})
+            logger.warning("Попытка настроить повтор для несуществующего напоминания ID: %s", reminder_id)
             return
             
-        user_states[message.chat.id] = {
-            'state': 'waiting_for_repeat_interval',
-            'reminder_id': reminder_id
-        }
+        set_user_state(message.chat.id, message.from_user.id,
+                       'waiting_for_repeat_interval', reminder_id=reminder_id)
         bot.send_message(
             message.chat.id,
             f"Выберите интервал повторения для напоминания <b>{reminder_id}</b>:",
             parse_mode='HTML',
             reply_markup=create_repeat_keyboard()
         )
-        logger.info(f"Настройка повтора для напоминания ID: {reminder_id}", 
-                   extra={'chat_id': message.chat.id, 
-                          'username': message.from_user.username or message.from_user.first_name,
-                          'reminder_text': reminder[1]})
+        logger.info("Настройка повтора для напоминания ID: %s, текст: '%s'", reminder_id, reminder[1])
     except ValueError:
         bot.send_message(
             message.chat.id,
@@ -460,16 +882,9 @@ def process_repeat_id(message):
             parse_mode='HTML',
             reply_markup=create_main_keyboard()
         )
-        logger.warning("Некорректный ввод ID для настройки повтора", 
-                     extra={'chat_id': message.chat.id, 
-                            'username': message.from_user.username or message.from_user.first_name,
-                            'reminder_text': 'N/A'})
+        logger.warning("Некорректный ввод ID для настройки повтора")
     except Exception as e:
-        logger.error(f"Ошибка обработки ID для повтора: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка обработки ID для повтора: %s", e, exc_info=True)
         bot.send_message(
             message.chat.id,
             "❌ Ошибка при обработке запроса",
@@ -480,33 +895,38 @@ def process_repeat_id(message):
 def handle_repeat_selection(call):
     try:
         chat_id = call.message.chat.id
-        if user_states.get(chat_id, {}).get('state') != 'waiting_for_repeat_interval':
+        state, data = get_user_state(chat_id, call.from_user.id)
+        if state != 'waiting_for_repeat_interval':
             bot.answer_callback_query(call.id, "Неверный контекст")
             return
             
-        reminder_id = user_states[chat_id]['reminder_id']
+        reminder_id = data['reminder_id']
         interval = call.data.split('_')[1]
         
-        cursor.execute(
-            'SELECT text FROM reminders WHERE id = ? AND chat_id = ?',
+        reminder_text, next_ts = store.db(chat_id).query_one(
+            'SELECT text, next_ts FROM reminders WHERE id = ? AND chat_id = ?',
             (reminder_id, chat_id)
         )
-        reminder_text = cursor.fetchone()[0]
         
-        if interval == 'none':
-            cursor.execute(
-                'UPDATE reminders SET repeat_interval = NULL WHERE id = ?',
-                (reminder_id,)
+        if interval == 'custom':
+            bot.set_state(call.from_user.id, 'waiting_for_repeat_rule', chat_id)
+            bot.edit_message_text(
+                f"✏️ Введите правило повтора для напоминания <b>{reminder_id}</b> в формате RRULE.\n\n"
+                "Например, по понедельникам и средам:\n"
+                "<code>FREQ=WEEKLY;BYDAY=MO,WE</code>",
+                chat_id,
+                call.message.message_id,
+                parse_mode='HTML'
             )
+            return
+        
+        rule = None if interval == 'none' else build_repeat_rule(interval, next_ts, get_chat_timezone(chat_id))
+        save_repeat_rule(chat_id, reminder_id, rule)
+        if rule is None:
             message_text = f"🔄 Повтор для напоминания <b>{reminder_id}</b> отключен"
         else:
-            cursor.execute(
-                'UPDATE reminders SET repeat_interval = ? WHERE id = ?',
-                (interval, reminder_id)
-            )
-            message_text = f"🔄 Установлен повтор для напоминания <b>{reminder_id}</b>: {interval}"
+            message_text = f"🔄 Установлен повтор для напоминания <b>{reminder_id}</b>: {describe_rule(rule)}"
         
-        conn.commit()
         bot.edit_message_text(
             message_text,
             chat_id,
@@ -518,106 +938,542 @@ def handle_repeat_selection(call):
             "Готово! ✅",
             reply_markup=create_main_keyboard()
         )
-        logger.info(f"Установлен повтор для напоминания ID: {reminder_id}, интервал: {interval}", 
-                   extra={'chat_id': chat_id, 
-                          'username': call.from_user.username or call.from_user.first_name,
-                          'reminder_text': reminder_text})
-        user_states.pop(chat_id, None)
+        logger.info("Установлен повтор для напоминания ID: %s, интервал: %s, текст: '%s'",
+                    reminder_id, interval, reminder_text)
+        clear_user_state(chat_id, call.from_user.id)
+    except Exception as e:
+        logger.error("Ошибка в handle_repeat_selection: %s", e, exc_info=True)
+        bot.answer_callback_query(call.id, "❌ Произошла ошибка")
+
+# Правило отсчитывается от time_ts (см. plan_occurrences), поэтому при смене
+# правила точкой отсчета становится текущий срок напоминания
+def save_repeat_rule(chat_id, reminder_id, rule):
+    store.writes(chat_id).execute(
+        'UPDATE reminders SET repeat_interval = ?, time_ts = next_ts, time = next_time WHERE id = ?',
+        (rule, reminder_id)
+    ).result(WRITE_TIMEOUT)
+    scheduler.refresh((store.shard(chat_id), reminder_id))
+    listing_cache.invalidate(chat_id)
+
+def process_repeat_rule(message):
+    try:
+        state, data = get_user_state(message.chat.id, message.from_user.id)
+        reminder_id = data['reminder_id']
+        rule = message.text.strip().upper()
+        next_ts, = store.db(message.chat.id).query_one(
+            'SELECT next_ts FROM reminders WHERE id = ? AND chat_id = ?',
+            (reminder_id, message.chat.id)
+        )
+        validate_rule(rule, next_ts, get_chat_timezone(message.chat.id))
+        save_repeat_rule(message.chat.id, reminder_id, rule)
+        bot.send_message(
+            message.chat.id,
+            f"🔄 Установлен повтор для напоминания <b>{reminder_id}</b>: <code>{rule}</code>",
+            parse_mode='HTML',
+            reply_markup=create_main_keyboard()
+        )
+        logger.info("Установлено правило повтора для напоминания ID: %s, правило: %s", reminder_id, rule)
+    except ValueError:
+        bot.send_message(
+            message.chat.id,
+            "❌ <b>Некорректное правило!</b>\nПример: <code>FREQ=WEEKLY;BYDAY=MO,WE</code>",
+            parse_mode='HTML',
+            reply_markup=create_main_keyboard()
+        )
+        logger.warning("Некорректное правило повтора")
+    except Exception as e:
+        logger.error("Ошибка установки правила повтора: %s", e, exc_info=True)
+        bot.send_message(
+            message.chat.id,
+            "❌ Ошибка при обработке запроса",
+            reply_markup=create_main_keyboard()
+        )
+    finally:
+        clear_user_state(message.chat.id, message.from_user.id)
+
+def ask_for_timezone(message):
+    try:
+        set_user_state(message.chat.id, message.from_user.id, 'waiting_for_timezone')
+        current = get_chat_timezone(message.chat.id).zone
+        bot.send_message(
+            message.chat.id,
+            f"🌍 Текущий часовой пояс: <b>{current}</b>\n\n"
+            "Выберите новый или введите название из базы IANA, например "
+            "<code>Europe/Berlin</code>:",
+            parse_mode='HTML',
+            reply_markup=create_timezone_keyboard()
+        )
+        logger.info("Запрос часового пояса")
     except Exception as e:
-        logger.error(f"Ошибка в handle_repeat_selection: {str(e)}", 
-                    extra={'chat_id': call.message.chat.id, 
-                           'username': call.from_user.username or call.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка в ask_for_timezone: %s", e, exc_info=True)
+
+def apply_timezone(chat_id, user, name):
+    set_chat_timezone(chat_id, name)
+    now_local = datetime.now(get_timezone(name)).strftime("%d.%m.%Y %H:%M")
+    bot.send_message(
+        chat_id,
+        f"✅ Часовой пояс <b>{name}</b> установлен. Сейчас у вас {now_local}",
+        parse_mode='HTML',
+        reply_markup=create_main_keyboard()
+    )
+    logger.info("Установлен часовой пояс: %s", name)
+
+def process_timezone(message):
+    try:
+        name = TIMEZONE_NAMES.get(message.text.strip().lower())
+        if name is None:
+            bot.send_message(
+                message.chat.id,
+                "❌ Неизвестный часовой пояс! Пример: <code>Europe/Moscow</code>",
+                parse_mode='HTML',
+                reply_markup=create_main_keyboard()
+            )
+            logger.warning("Некорректный часовой пояс: %s", message.text)
+            return
+        apply_timezone(message.chat.id, message.from_user, name)
+    except Exception as e:
+        logger.error("Ошибка установки часового пояса: %s", e, exc_info=True)
+        bot.send_message(
+            message.chat.id,
+            "❌ Ошибка при установке часового пояса",
+            reply_markup=create_main_keyboard()
+        )
+    finally:
+        clear_user_state(message.chat.id, message.from_user.id)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('tz_'))
+def handle_timezone_selection(call):
+    try:
+        chat_id = call.message.chat.id
+        name = call.data[len('tz_'):]
+        if name not in pytz.all_timezones_set:
+            bot.answer_callback_query(call.id, "Неверный часовой пояс")
+            return
+        bot.answer_callback_query(call.id)
+        apply_timezone(chat_id, call.from_user, name)
+        clear_user_state(chat_id, call.from_user.id)
+    except Exception as e:
+        logger.error("Ошибка в handle_timezone_selection: %s", e, exc_info=True)
         bot.answer_callback_query(call.id, "❌ Произошла ошибка")
 
+# Метрики планировщика и отправки (metrics.py); endpoint включается METRICS_PORT,
+# а собираются значения всегда — запись в ячейку потока ничего не стоит
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+def count_due():
+    now_ts = int(time.time())
+    return {(str(shard),): db.query_one(schema.SQL_COUNT_DUE, (now_ts,))[0]
+            for shard, db in enumerate(store.databases)}
+
+scheduler_lag = metrics.REGISTRY.histogram(
+    'reminder_scheduler_lag_seconds', 'Задержка захвата напоминания после его срока')
+scheduler_tick = metrics.REGISTRY.histogram(
+    'reminder_scheduler_tick_seconds', 'Длительность захвата и отправки одной пачки')
+claimed_total = metrics.REGISTRY.counter(
+    'reminder_claimed_total', 'Захвачено напоминаний к отправке')
+delivery_total = metrics.REGISTRY.counter(
+    'reminder_delivery_total', 'Итоги отправки напоминаний', ('result',))
+api_latency = metrics.REGISTRY.histogram(
+    'telegram_request_seconds', 'Длительность запросов к Bot API', ('method',))
+api_errors = metrics.REGISTRY.counter(
+    'telegram_request_errors_total', 'Ошибки запросов к Bot API', ('method',))
+metrics.REGISTRY.gauge('reminder_due', 'Активных напоминаний с наступившим сроком', ('shard',), count_due)
+metrics.REGISTRY.gauge('reminder_scheduled', 'Сроков в куче планировщика', fn=lambda: len(scheduler))
+metrics.REGISTRY.gauge('delivery_queue_depth', 'Напоминаний в очередях отправителей', fn=delivery_pool.depth)
+metrics.REGISTRY.gauge('handler_queue_depth', 'Апдейтов в очереди пула обработчиков telebot',
+                       fn=lambda: bot.worker_pool.tasks.qsize() if bot.threaded else 0)
+metrics.REGISTRY.gauge('log_queue_depth', 'Записей в очереди логов', fn=log_queue.depth)
+metrics.REGISTRY.gauge('log_records_dropped', 'Потеряно записей лога', fn=lambda: log_queue.dropped)
+metrics.REGISTRY.gauge('listing_cache_lookups', 'Обращения к кэшу списков', ('result',),
+                       lambda: {('hit',): listing_cache.hits, ('miss',): listing_cache.misses})
+
+# Все запросы telebot к API проходят через apihelper._make_request
+def timed_request(make_request):
+    def wrapper(token, method_name, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except Exception:
+            api_errors.inc(labels=(method_name,))
+            raise
+        finally:
+            api_latency.observe(time.perf_counter() - started, (method_name,))
+    return wrapper
+
+apihelper._make_request = timed_request(apihelper._make_request)
+
+def claim_due_reminders(shard):
+    now_ts = int(time.time())
+    with store.databases[shard].transaction() as conn:
+        reminders = conn.execute(
+            schema.SQL_CLAIM_DUE,
+            (WORKER_ID, now_ts + LEASE_SECONDS, now_ts, now_ts, CLAIM_BATCH_SIZE)
+        ).fetchall()
+    reminders.sort(key=lambda rem: (rem[4], rem[0]))
+    claimed_total.inc(len(reminders))
+    for rem in reminders:
+        scheduler_lag.observe(now_ts - rem[4])
+    return reminders
+
+def send_reminder(rem, messages):
+    started = time.time()
+    try:
+        for text in messages:
+            bot.send_message(
+                rem[1], 
+                text, 
+                parse_mode='HTML'
+            )
+        delivery_log.record(rem[4], started, time.time(), True)
+        logger.info(
+            "Отправлено напоминание: ID=%s, Текст='%s', сообщений: %s", rem[0], rem[2], len(messages)
+        )
+        return None
+    except Exception as e:
+        delivery_log.record(rem[4], started, time.time(), False)
+        logger.error(
+            "Ошибка отправки напоминания ID=%s: %s", rem[0], e, exc_info=not isinstance(e, ApiTelegramException)
+        )
+        return e
+
+def classify_send_error(error):
+    # Возвращает (класс ошибки, сколько секунд просит подождать Telegram)
+    if isinstance(error, ApiTelegramException):
+        description = (error.description or '').lower()
+        if error.error_code == 403:
+            return 'forbidden', None
+        if error.error_code == 400 and 'chat not found' in description:
+            return 'chat_not_found', None
+        if error.error_code == 429:
+            return 'rate_limited', error.result_json.get('parameters', {}).get('retry_after')
+        if error.error_code >= 500:
+            return 'server_error', None
+        return 'bad_request', None
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return 'network', None
+    return 'unknown', None
+
+def get_retry_delay(attempt, retry_after=None):
+    delay = min(RETRY_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+    delay = random.uniform(delay / 2, delay)
+    return int(max(delay, retry_after or 0))
+
+def load_send_attempts(shard, reminder_ids):
+    if not reminder_ids:
+        return {}
+    placeholders = ', '.join('?' * len(reminder_ids))
+    return dict(store.databases[shard].query(
+        f"SELECT reminder_id, attempts FROM outbox WHERE reminder_id IN ({placeholders})",
+        reminder_ids
+    ))
+
+def build_reminder_messages(rem, missed, last_due, now):
+    text = f"🔔 <b>Напоминание:</b> {rem[2]}"
+    late = (now - last_due).total_seconds() > CATCHUP_GRACE
+    if not rem[3] or (missed == 1 and not late):
+        return [text]
+    if CATCHUP_POLICY == 'all' and missed <= CATCHUP_MAX_MESSAGES:
+        return [text] * missed
+    if CATCHUP_POLICY == 'skip':
+        return [] if late else [text]
+    return [f"{text}\n\n⏳ Пропущено повторений: {missed}"]
+
+def deliver_claimed(shard, reminders):
+    # Следующие сроки считаются сразу для всей пачки, одним прыжком через простой
+    now = datetime.now(pytz.utc)
+    plans = plan_occurrences(reminders, now)
+    futures = {}
+    skipped = []
+    for rem in reminders:
+        missed, last_due, new_time = plans[rem[0]]
+        messages = build_reminder_messages(rem, missed, last_due, now)
+        if messages:
+            futures[delivery_pool.submit(rem, messages)] = rem
+        else:
+            skipped.append(rem)
+            logger.info(
+                "Пропущено устаревших повторов напоминания ID=%s, чат %s: %s", rem[0], rem[1], missed
+            )
+    
+    # Все переходы состояния за тик записываются одной транзакцией
+    now_ts = int(time.time())
+    deactivated = []
+    rescheduled = []
+    delivered = []
+    retried = []
+    dead = []
+    dead_chats = set()
+    changed_chats = set()
+    outbox_rows = []
+    results = [(futures[future], future.result()) for future in as_completed(futures)]
+    results += [(rem, None) for rem in skipped]
+    failures = [(rem, error) for rem, error in results if error is not None]
+    attempts = load_send_attempts(shard, [rem[0] for rem, error in failures])
+    
+    for rem, error in results:
+        if error is not None:
+            continue
+        delivered.append((rem[0],))
+        changed_chats.add(rem[1])
+        new_time = plans[rem[0]][2]
+        if new_time:
+            rescheduled.append((new_time, rem[0]))
+        else:
+            deactivated.append((rem[0], WORKER_ID))
+    
+    for rem, error in failures:
+        error_class, retry_after = classify_send_error(error)
+        attempt = attempts.get(rem[0], 0) + 1
+        next_attempt_at = None
+        if error_class in CHAT_GONE_ERRORS:
+            dead_chats.add(rem[1])
+        if error_class in PERMANENT_ERRORS or attempt >= MAX_SEND_ATTEMPTS:
+            status = 'dead'
+            dead.append((rem[0],))
+            changed_chats.add(rem[1])
+            logger.warning(
+                "Напоминание ID=%s, чат %s, переведено в dead letter: %s, попыток: %s",
+                rem[0], rem[1], error_class, attempt
+            )
+        else:
+            # Строка остается за нами до next_attempt_at, после этого ее заберет любой процесс
+            status = 'retry'
+            next_attempt_at = now_ts + get_retry_delay(attempt, retry_after)
+            retried.append((next_attempt_at, rem[0], WORKER_ID))
+        outbox_rows.append((rem[0], rem[1], attempt, next_attempt_at, error_class,
+                            str(error)[:500], status, now_ts))
+    delivery_total.inc(len(delivered) - len(skipped), ('sent',))
+    delivery_total.inc(len(skipped), ('skipped',))
+    delivery_total.inc(len(retried), ('retry',))
+    delivery_total.inc(len(dead), ('dead',))
+    
+    dead_ids = [rem_id for rem_id, in dead]
+    with store.databases[shard].transaction() as conn:
+        conn.executemany(
+            "UPDATE reminders SET is_active = 0, claimed_by = NULL, lease_until = NULL "
+            "WHERE id = ? AND claimed_by = ?",
+            deactivated
+        )
+        conn.executemany(
+            "UPDATE reminders SET next_ts = ?, next_time = ?, claimed_by = NULL, lease_until = NULL "
+            "WHERE id = ? AND claimed_by = ?",
+            [(int(new_time.timestamp()), new_time.astimezone(TIMEZONE).strftime("%Y-%m-%d %H:%M"), rem_id, WORKER_ID)
+             for new_time, rem_id in rescheduled]
+        )
+        conn.executemany(
+            "UPDATE reminders SET lease_until = ? WHERE id = ? AND claimed_by = ?",
+            retried
+        )
+        conn.executemany(
+            "UPDATE reminders SET is_active = 0, claimed_by = NULL, lease_until = NULL WHERE id = ?",
+            dead
+        )
+        # Чат, где бот заблокирован или удален, больше не получит ни одного напоминания
+        for chat_id in dead_chats:
+            dead_ids += [row[0] for row in conn.execute(
+                "UPDATE reminders SET is_active = 0, claimed_by = NULL, lease_until = NULL "
+                "WHERE chat_id = ? AND is_active = 1 RETURNING id",
+                (chat_id,)
+            ).fetchall()]
+        conn.executemany(
+            """INSERT INTO outbox(reminder_id, chat_id, attempts, next_attempt_at,
+                                  error_class, last_error, status, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(reminder_id) DO UPDATE SET
+                   attempts = excluded.attempts,
+                   next_attempt_at = excluded.next_attempt_at,
+                   error_class = excluded.error_class,
+                   last_error = excluded.last_error,
+                   status = excluded.status,
+                   updated_at = excluded.updated_at""",
+            outbox_rows
+        )
+        conn.executemany("DELETE FROM outbox WHERE reminder_id = ?", delivered)
+    
+    for new_time, rem_id in rescheduled:
+        scheduler.schedule((shard, rem_id), int(new_time.timestamp()))
+    for next_attempt_at, rem_id, _ in retried:
+        scheduler.schedule((shard, rem_id), next_attempt_at)
+    for rem_id in dead_ids:
+        scheduler.cancel((shard, rem_id))
+    for chat_id in changed_chats | dead_chats:
+        listing_cache.invalidate(chat_id)
+    if dead_chats:
+        logger.warning("Отключены напоминания недоступных чатов: %s", sorted(dead_chats))
+
+# Строки, записанные без next_ts после старта (см. schema.backfill_text_only)
+def backfill_text_only():
+    total = 0
+    for shard, db in enumerate(store.databases):
+        backfilled = schema.backfill_text_only(db.connection())
+        if backfilled:
+            logger.warning("Шард %s: дописан next_ts строкам без него: %s", shard, backfilled)
+        total += backfilled
+    return total
+
+def poll_unleased():
+    now_ts = int(time.time())
+    for shard, db in enumerate(store.databases):
+        row = db.query_one(schema.SQL_NEXT_UNLEASED, (now_ts,))
+        if row:
+            scheduler.schedule((shard, row[0]), row[1])
+
 def check_reminders():
     while True:
         try:
-            now = datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M")
-            logger.info(f"Проверка напоминаний в {now}", 
-                      extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
-            
-            cursor.execute(
-                "SELECT id, chat_id, text, repeat_interval, next_time "
-                "FROM reminders WHERE next_time <= ? AND is_active = 1",
-                (now,)
-            )
-            reminders = cursor.fetchall()
+            count = scheduler.load()
+            logger.info("Планировщик загружен, активных напоминаний: %s; очередь логов: %s, потеряно: %s",
+                        count, log_queue.depth(), log_queue.dropped)
             
-            for rem in reminders:
-                try:
-                    bot.send_message(
-                        rem[1], 
-                        f"🔔 <b>Напоминание:</b> {rem[2]}", 
-                        parse_mode='HTML'
-                    )
-                    logger.info(
-                        f"Отправлено напоминание: ID={rem[0]}, Текст='{rem[2]}'",
-                        extra={'chat_id': rem[1], 
-                               'username': 'SYSTEM',
-                               'reminder_text': rem[2]}
-                    )
-                    
-                    if rem[3]:  # Если есть повтор
-                        update_repeated_reminder(rem)
-                    else:
-                        cursor.execute(
-                            "UPDATE reminders SET is_active = 0 WHERE id = ?",
-                            (rem[0],)
-                        )
-                        conn.commit()
-                except Exception as e:
-                    logger.error(
-                        f"Ошибка отправки напоминания ID={rem[0]}: {str(e)}",
-                        extra={'chat_id': rem[1], 
-                               'username': 'SYSTEM',
-                               'reminder_text': rem[2]}, 
-                        exc_info=True
-                    )
-                    time.sleep(5)
-
-            time.sleep(30)
+            resync_at = time.time() + RESYNC_INTERVAL
+            while True:
+                # Куча лишь подсказывает, когда проснуться; что отправлять, решает аренда в БД
+                scheduler.wait_due(SCHEDULER_POLL_INTERVAL if SCHEDULER_ONLY else RESYNC_INTERVAL)
+                if SCHEDULER_ONLY:
+                    poll_unleased()
+                if time.time() >= resync_at:
+                    resync_at = time.time() + RESYNC_INTERVAL
+                    logger.info("Пересинхронизация: сроков в куче: %s; очередь логов: %s, потеряно: %s",
+                                len(scheduler), log_queue.depth(), log_queue.dropped)
+                    if backfill_text_only():
+                        scheduler.load()
+                for shard in range(len(store)):
+                    while True:
+                        started = time.perf_counter()
+                        reminders = claim_due_reminders(shard)
+                        if reminders:
+                            deliver_claimed(shard, reminders)
+                            scheduler_tick.observe(time.perf_counter() - started)
+                        if len(reminders) < CLAIM_BATCH_SIZE:
+                            break
         except Exception as e:
-            logger.error(f"Ошибка в check_reminders: {str(e)}", 
-                        extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'}, 
-                        exc_info=True)
+            # После сбоя заново загружаем кучу из БД, чтобы не потерять извлеченные сроки
+            logger.error("Ошибка в check_reminders: %s", e, exc_info=True)
             time.sleep(60)
 
-def update_repeated_reminder(reminder):
+# Уплотнение: отработавшие напоминания старше срока хранения уходят в архив,
+# чтобы горячая таблица и ее индексы росли только вместе с живыми напоминаниями
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', '30'))
+ARCHIVE_INTERVAL = 3600  # сек между проходами
+
+def compact_reminders():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        try:
+            started = time.time()
+            archived = freed = 0
+            for db in store.databases:
+                conn = db.connection()
+                archived += schema.archive_inactive(conn, int(started) - ARCHIVE_RETENTION_DAYS * 86400)
+                freed += schema.incremental_vacuum(conn) or 0
+            bot.current_states.purge_expired()
+            if archived or freed:
+                logger.info("Архивировано напоминаний: %s, освобождено страниц: %s, за %.1f с",
+                            archived, freed, time.time() - started)
+        except Exception as e:
+            logger.error("Ошибка в compact_reminders: %s", e, exc_info=True)
+
+# Опоздание доставки: отправители пишут в кольцевой буфер, раз в STATS_FLUSH_INTERVAL
+# он сливается в поминутные строки delivery_stats (шард 0, как и bot_states)
+DELIVERY_LOG_SIZE = int(os.getenv('DELIVERY_LOG_SIZE', str(delivery_stats.DELIVERY_LOG_SIZE)))
+STATS_FLUSH_INTERVAL = 60  # сек
+STATS_RETENTION_DAYS = int(os.getenv('STATS_RETENTION_DAYS', '7'))
+# Telegram id пользователей, которым доступна /stats, через запятую
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+delivery_log = delivery_stats.DeliveryLog(DELIVERY_LOG_SIZE)
+
+def flush_delivery_stats():
+    rows = delivery_stats.aggregate(delivery_log.drain())
+    if not rows:
+        return None
+    return store.writers[0].submit(lambda conn: delivery_stats.save(conn, rows))
+
+def aggregate_deliveries():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            flush_delivery_stats()
+            store.writers[0].execute(
+                'DELETE FROM delivery_stats WHERE minute < ?',
+                (int(time.time()) - STATS_RETENTION_DAYS * 86400,)
+            )
+        except Exception as e:
+            logger.error("Ошибка в aggregate_deliveries: %s", e, exc_info=True)
+
+def format_lag(value):
+    if value is None:
+        return "—"
+    if value == float('inf'):
+        return f"> {schema.LAG_BUCKETS[-1]} с"
+    return f"≤ {value} с"
+
+def render_stats(title, stats, minutes):
+    attempts = stats['sent'] + stats['failed']
+    failure_rate = stats['failed'] / attempts * 100 if attempts else 0
+    send_avg = f"{stats['send_avg'] * 1000:.0f} мс" if stats['send_avg'] is not None else "—"
+    return (
+        f"<b>{title}</b>\n"
+        f"Опоздание p50 / p95 / p99: {format_lag(stats['p50'])} / "
+        f"{format_lag(stats['p95'])} / {format_lag(stats['p99'])}\n"
+        f"Отправок в минуту: {stats['sent'] / minutes:.2f}\n"
+        f"Ошибок: {stats['failed']} из {attempts} ({failure_rate:.1f}%)\n"
+        f"Среднее время отправки: {send_avg}\n"
+    )
+
+@bot.message_handler(commands=['stats'], func=lambda m: m.from_user.id in ADMIN_IDS)
+def handle_stats_command(message):
     try:
-        rem_id, chat_id, text, interval, next_time = reminder
-        next_time_obj = TIMEZONE.localize(datetime.strptime(next_time, "%Y-%m-%d %H:%M"))
-        
-        if interval == 'daily':
-             new_time = next_time_obj + timedelta(days=1)
-        elif interval == 'weekly':
-            new_time = next_time_obj + timedelta(weeks=1)
-        elif interval == 'monthly':
-            new_time = next_time_obj + relativedelta(months=1)
-        else:
-            return
-            
-        new_time_str = new_time.strftime("%Y-%m-%d %H:%M")
-        cursor.execute(
-            'UPDATE reminders SET next_time = ? WHERE id = ?',
-            (new_time_str, rem_id)
-        )
-        conn.commit()
+        # Досылаем еще не слитые записи, чтобы в окне была последняя минута
+        pending = flush_delivery_stats()
+        if pending is not None:
+            pending.result(WRITE_TIMEOUT)
+        now_ts = int(time.time())
+        db = store.databases[0]
+        text = "📊 <b>Доставка напоминаний</b>\n\n"
+        text += render_stats("За час", delivery_stats.window(db, now_ts - 3600), 60) + "\n"
+        text += render_stats("За сутки", delivery_stats.window(db, now_ts - 86400), 1440)
+        text += f"\nВ очереди отправки: {delivery_pool.depth()}, потеряно записей учета: {delivery_log.lost}"
+        bot.send_message(message.chat.id, text, parse_mode='HTML')
+        logger.info("Показана статистика доставки")
     except Exception as e:
-        logger.error(f"Ошибка обновления повторяющегося напоминания ID={rem_id}: {str(e)}", 
-                    extra={'chat_id': chat_id, 
-                           'username': 'SYSTEM',
-                           'reminder_text': text}, 
-                    exc_info=True)
-        time.sleep(5)
+        logger.error("Ошибка в handle_stats_command: %s", e, exc_info=True)
+
+def plan_occurrences(reminders, now):
+    # Для каждой строки пачки: (число наступивших сроков, последний из них, следующий срок в будущем)
+    plans = {}
+    for rem_id, chat_id, text, rule_text, next_ts, time_ts in reminders:
+        tz = get_chat_timezone(chat_id)
+        due = datetime.fromtimestamp(next_ts, tz)
+        plans[rem_id] = (1, due, None)
+        if not rule_text:
+            continue
+        try:
+            # Считаем в местном времени: повтор привязан к часам на стене, а не к UTC.
+            # Начало правила — time_ts, а не текущий срок: иначе COUNT и UNTIL
+            # отсчитывались бы заново от каждой отправки и правило не кончалось бы
+            start = datetime.fromtimestamp(time_ts or next_ts, tz).replace(tzinfo=None)
+            due_local = due.replace(tzinfo=None)
+            now_local = now.astimezone(tz).replace(tzinfo=None)
+            rule = compile_rule(rule_text).replace(dtstart=start)
+            passed = [d for d in rule.between(due_local, now_local, inc=True) if d > due_local]
+            following = rule.after(now_local)
+            plans[rem_id] = (
+                1 + len(passed),
+                tz.localize(passed[-1]) if passed else due,
+                tz.localize(following) if following else None
+            )
+        except Exception as e:
+            logger.error("Ошибка обновления повторяющегося напоминания ID=%s, чат %s, текст: '%s': %s",
+                         rem_id, chat_id, text, e, exc_info=True)
+    return plans
 
 # Обработчик текстовых сообщений
 @bot.message_handler(func=lambda message: True)
 def handle_text(message):
     try:
         chat_id = message.chat.id
-        state = user_states.get(chat_id, {}).get('state')
+        state = bot.get_state(message.from_user.id, chat_id)
         
         if state == 'waiting_for_reminder':
             process_reminder(message)
@@ -625,6 +1481,10 @@ def handle_text(message):
             delete_reminder(message)
         elif state == 'waiting_for_repeat_id':
             process_repeat_id(message)
+        elif state == 'waiting_for_repeat_rule':
+            process_repeat_rule(message)
+        elif state == 'waiting_for_timezone':
+            process_timezone(message)
         else:
             bot.send_message(
                 chat_id,
@@ -632,41 +1492,42 @@ def handle_text(message):
                 reply_markup=create_main_keyboard()
             )
     except Exception as e:
-        logger.error(f"Ошибка обработки сообщения: {str(e)}", 
-                    extra={'chat_id': message.chat.id, 
-                           'username': message.from_user.username or message.from_user.first_name,
-                           'reminder_text': 'N/A'}, 
-                    exc_info=True)
+        logger.error("Ошибка обработки сообщения: %s", e, exc_info=True)
 
 # Запуск бота
 if __name__ == '__main__':
     try:
-        logger.info("----- Запуск бота -----", 
-                   extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
+        logger.info("----- Запуск бота -----")
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+            logger.info("Метрики доступны на http://127.0.0.1:%s/metrics", METRICS_PORT)
+        
+        threading.Thread(target=aggregate_deliveries, name='delivery-stats', daemon=True).start()
+        
+        if SCHEDULER_ONLY:
+            # Дополнительный процесс доставки без приема сообщений: делит таблицу
+            # с основным ботом через аренду напоминаний
+            logger.info("Запуск только планировщика, воркер %s", WORKER_ID)
+            check_reminders()
         
         reminder_thread = threading.Thread(target=check_reminders, daemon=True)
         reminder_thread.start()
-        logger.info(f"Поток проверки напоминаний запущен: {reminder_thread.is_alive()}", 
-                   extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
+        threading.Thread(target=compact_reminders, name='compaction', daemon=True).start()
+        logger.info("Поток проверки напоминаний запущен: %s", reminder_thread.is_alive())
         
         bot.infinity_polling()
         
     except KeyboardInterrupt:
-        logger.info("Бот остановлен по запросу пользователя", 
-                   extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
+        logger.info("Бот остановлен по запросу пользователя")
     except Exception as e:
-        logger.critical(f"Критическая ошибка: {str(e)}", 
-                       extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'}, 
-                       exc_info=True)
+        logger.critical("Критическая ошибка: %s", e, exc_info=True)
     finally:
         try:
-            conn.close()
-            logger.info("Соединение с БД закрыто", 
-                       extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
+            flush_delivery_stats()
+            store.close()
+            logger.info("Соединение с БД закрыто")
         except Exception as e:
-            logger.error(f"Ошибка при закрытии соединения с БД: {str(e)}", 
-                        extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
+            logger.error("Ошибка при закрытии соединения с БД: %s", e)
         
-        logger.info("----- Работа бота завершена -----", 
-                   extra={'chat_id': 'SYSTEM', 'username': 'SYSTEM', 'reminder_text': 'N/A'})
+        logger.info("----- Работа бота завершена -----")
         
\ No newline at end of file
@@ -0,0 +1,93 @@
+import threading
+from array import array
+from bisect import bisect_left
+import schema
+
+# Учет опоздания доставки. Каждая отправка оставляет в кольцевом буфере три
+# отметки времени: срок напоминания, начало отправки и ответ API. Раз в минуту
+# буфер сливается в поминутные строки delivery_stats (см. schema), а /stats
+# считает окна по этим строкам, не перечитывая сырые записи.
+# Если буфер переполнился до слива, старые записи теряются и учитываются в lost
+
+DELIVERY_LOG_SIZE = 65536
+
+class DeliveryLog:
+    def __init__(self, size=DELIVERY_LOG_SIZE):
+        self.size = size
+        self._due = array('d', bytes(8 * size))
+        self._started = array('d', bytes(8 * size))
+        self._acked = array('d', bytes(8 * size))
+        self._ok = array('b', bytes(size))
+        self._written = 0
+        self._drained = 0
+        self.lost = 0
+        self._lock = threading.Lock()
+
+    def record(self, due, started, acked, ok):
+        with self._lock:
+            i = self._written % self.size
+            self._due[i] = due
+            self._started[i] = started
+            self._acked[i] = acked
+            self._ok[i] = ok
+            self._written += 1
+
+    # Записи, появившиеся после прошлого слива: (срок, начало, ответ, успех)
+    def drain(self):
+        with self._lock:
+            begin = max(self._drained, self._written - self.size)
+            self.lost += begin - self._drained
+            entries = []
+            for n in range(begin, self._written):
+                i = n % self.size
+                entries.append((self._due[i], self._started[i], self._acked[i], self._ok[i]))
+            self._drained = self._written
+        return entries
+
+# Записи -> параметры SQL_DELIVERY_STATS_UPSERT, по строке на минуту ответа API.
+# Опоздание считается только для доставленных: ответ API минус срок
+def aggregate(entries):
+    rows = {}
+    for due, started, acked, ok in entries:
+        minute = int(acked) // 60 * 60
+        row = rows.get(minute)
+        if row is None:
+            row = rows[minute] = [minute, 0, 0, 0.0] + [0] * len(schema.LAG_COLUMNS)
+        if ok:
+            row[1] += 1
+            row[4 + bisect_left(schema.LAG_BUCKETS, max(acked - due, 0))] += 1
+        else:
+            row[2] += 1
+        row[3] += acked - started
+    return [tuple(row) for row in rows.values()]
+
+def save(conn, rows):
+    conn.executemany(schema.SQL_DELIVERY_STATS_UPSERT, rows)
+    return len(rows)
+
+# Квантиль по корзинам: верхняя граница корзины, в которой он оказался;
+# None — данных нет, inf — дольше последней границы
+def percentile(counts, q):
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(schema.LAG_BUCKETS + (float('inf'),), counts):
+        seen += count
+        if seen >= q * total:
+            return bound
+    return float('inf')
+
+# Сводка за окно: отправлено, ошибок, среднее время отправки, квантили опоздания
+def window(db, since):
+    row = db.query_one(schema.SQL_DELIVERY_STATS_WINDOW, (since,))
+    sent, failed, send_seconds = int(row[0]), int(row[1]), row[2]
+    counts = [int(count) for count in row[3:]]
+    return {
+        'sent': sent,
+        'failed': failed,
+        'send_avg': send_seconds / (sent + failed) if sent + failed else None,
+        'p50': percentile(counts, 0.50),
+        'p95': percentile(counts, 0.95),
+        'p99': percentile(counts, 0.99),
+    }
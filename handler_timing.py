@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from functools import wraps
+import bot_logging
+import metrics
+
+# Замер обработчиков telebot (включается HANDLER_TIMING=1 в боте).
+# Фильтры (_test_message_handler) и сам обработчик меряются отдельно и
+# попадают в гистограммы с меткой имени функции. Все, что дольше slow_ms,
+# пишется в лог; update_id и чат добавляет контекст апдейта (bot_logging).
+# Библиотека не меняется: переопределяются методы TeleBot, а функции
+# обработчиков оборачиваются один раз и кэшируются
+
+SLOW_HANDLER_MS = 1000
+
+class TimedTeleBot(bot_logging.ContextTeleBot):
+    def __init__(self, token, *args, logger=None, slow_ms=SLOW_HANDLER_MS, **kwargs):
+        super().__init__(token, *args, **kwargs)
+        self.timing_logger = logger or logging.getLogger(__name__)
+        self.slow_seconds = slow_ms / 1000
+        self.filter_seconds = metrics.REGISTRY.histogram(
+            'handler_filter_seconds', 'Проверка фильтров обработчика telebot', ('handler',))
+        self.handler_seconds = metrics.REGISTRY.histogram(
+            'handler_seconds', 'Выполнение обработчика telebot', ('handler',))
+        self._timed = {}  # id(словарь обработчика) -> (исходный словарь, копия с оберткой)
+        self._timed_lock = threading.Lock()
+
+    def _test_message_handler(self, message_handler, message):
+        started = time.perf_counter()
+        try:
+            return super()._test_message_handler(message_handler, message)
+        finally:
+            elapsed = time.perf_counter() - started
+            name = message_handler['function'].__name__
+            self.filter_seconds.observe(elapsed, (name,))
+            if elapsed >= self.slow_seconds:
+                self.timing_logger.warning("Медленные фильтры обработчика %s: %.0f мс", name, elapsed * 1000)
+
+    def _run_middlewares_and_handler(self, message, handlers, middlewares, update_type):
+        if handlers:
+            handlers = [self._timed_handler(handler) for handler in handlers]
+        return super()._run_middlewares_and_handler(message, handlers, middlewares, update_type)
+
+    # Копия словаря обработчика с замеряющей функцией; wraps сохраняет сигнатуру,
+    # по которой telebot решает, передавать ли data и bot
+    def _timed_handler(self, handler):
+        cached = self._timed.get(id(handler))
+        if cached is not None and cached[0] is handler:
+            return cached[1]
+        function = handler['function']
+        name = function.__name__
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.handler_seconds.observe(elapsed, (name,))
+                if elapsed >= self.slow_seconds:
+                    self.timing_logger.warning("Медленный обработчик %s: %.0f мс", name, elapsed * 1000)
+
+        timed_handler = dict(handler, function=timed)
+        with self._timed_lock:
+            self._timed[id(handler)] = (handler, timed_handler)
+        return timed_handler
@@ -0,0 +1,182 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Реестр метрик бота в текстовом формате Prometheus.
+# Счетчики и гистограммы пишутся без блокировок: у каждого потока свои ячейки,
+# складываются они только при чтении (запрос к /metrics). Ячейки живут, пока жив
+# объект метрики, — у бота потоки долгоживущие (пул telebot, отправители, планировщик).
+# Gauge может считаться функцией прямо в момент чтения (глубина очереди и т.п.)
+# Включение: METRICS_PORT (см. бот), сервер слушает только localhost
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    # Ячейка текущего потока: словарь метки -> значение, пишет в него только этот поток
+    def _cell(self):
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = {}
+            self._local.cell = cell
+            with self._lock:
+                self._cells.append(cell)
+        return cell
+
+    # dict.copy() под GIL атомарен, поэтому читать чужие ячейки можно без их блокировки
+    def _snapshots(self):
+        with self._lock:
+            cells = list(self._cells)
+        return [cell.copy() for cell in cells]
+
+    def _labels(self, labels, extra=''):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, labels=()):
+        cell = self._cell()
+        cell[labels] = cell.get(labels, 0) + value
+
+    def values(self):
+        totals = {}
+        for cell in self._snapshots():
+            for labels, value in cell.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def samples(self):
+        return [f'{self.name}{self._labels(labels)} {value}' for labels, value in sorted(self.values().items())]
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    # fn возвращает число или словарь метки -> число
+    def __init__(self, name, help_text, labelnames=(), fn=None):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+        self._values = {}
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def values(self):
+        if self.fn is None:
+            return dict(self._values)
+        value = self.fn()
+        return value if isinstance(value, dict) else {(): value}
+
+    def samples(self):
+        return [f'{self.name}{self._labels(labels)} {value}' for labels, value in sorted(self.values().items())]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    # Ячейка метки: счетчики по корзинам (последняя — +Inf) и сумма в конце
+    def observe(self, value, labels=()):
+        cell = self._cell()
+        counts = cell.get(labels)
+        if counts is None:
+            counts = cell[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def values(self):
+        totals = {}
+        for cell in self._snapshots():
+            for labels, counts in cell.items():
+                total = totals.setdefault(labels, [0] * (len(self.buckets) + 2))
+                for i, count in enumerate(list(counts)):
+                    total[i] += count
+        return totals
+
+    def samples(self):
+        lines = []
+        for labels, counts in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{self._labels(labels, le)} {cumulative}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {counts[-1]}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), fn=None):
+        return self.register(Gauge(name, help_text, labelnames, fn))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Запросы скрапера в лог бота не пишем
+    def log_message(self, format, *args):
+        pass
+
+# Один поток на все запросы: функции gauge могут читать базу, а у потока
+# свое соединение — новый поток на каждый скрейп плодил бы соединения
+def serve(port, host='127.0.0.1'):
+    server = HTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
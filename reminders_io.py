@@ -0,0 +1,220 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+import pytz
+import schema
+import storage
+
+# Массовая выгрузка и загрузка напоминаний. Строки читаются и пишутся потоком,
+# вставка идет пачками executemany, каждая пачка — одна транзакция.
+# Запуск: python reminders_io.py export reminders.jsonl [--db reminders.db]
+#         python reminders_io.py import reminders.csv [--db reminders.db] [--keep-ids]
+# С --shards N работает с шардами reminders.0.db ... (см. DB_SHARDS в боте):
+# выгрузка обходит все шарды, загрузка раскладывает строки по chat_id.
+# id уникальны только внутри шарда, поэтому выгрузка пишет в поле shards число
+# шардов источника, и --keep-ids принимает только файл с той же раскладкой
+# Файл '-' — stdout/stdin; формат берется из расширения или --format
+
+FIELDS = ['id', 'chat_id', 'username', 'text', 'time_ts', 'next_ts', 'repeat_interval', 'is_active']
+EXPORT_FIELDS = FIELDS + ['shards']
+CHUNK_SIZE = 10000
+FETCH_SIZE = 1000
+
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+def open_file(path, mode):
+    if path == '-':
+        return sys.stdout if mode == 'w' else sys.stdin
+    return open(path, mode, encoding='utf-8', newline='')
+
+def iter_records(f, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+# Запись из файла -> параметры INSERT. Текстовые time/next_time заполняются
+# из epoch для совместимости, как это делает бот
+def to_params(record, tz, keep_ids):
+    next_ts = int(record.get('next_ts') or record['time_ts'])
+    time_ts = int(record.get('time_ts') or next_ts)
+    active = record.get('is_active')
+    params = (
+        int(record['chat_id']),
+        record.get('username') or '',
+        record['text'],
+        datetime.fromtimestamp(time_ts, tz).strftime(schema.LEGACY_TIME_FORMAT),
+        datetime.fromtimestamp(next_ts, tz).strftime(schema.LEGACY_TIME_FORMAT),
+        time_ts,
+        next_ts,
+        record.get('repeat_interval') or None,
+        1 if active in (None, '') else int(active in (True, 1, '1', 'true', 'True')),
+    )
+    return ((int(record['id']),) + params) if keep_ids else params
+
+class Progress:
+    def __init__(self, label):
+        self.label = label
+        self.total = 0
+        self.started = time.time()
+
+    def add(self, count):
+        self.total += count
+        elapsed = time.time() - self.started
+        print(f'\r{self.label}: {self.total} строк, {self.total / max(elapsed, 1e-9):.0f} строк/с',
+              end='', file=sys.stderr, flush=True)
+
+    def done(self):
+        print(f'\nГотово: {self.total} строк за {time.time() - self.started:.1f} с', file=sys.stderr)
+
+def export_reminders(store, path, fmt):
+    progress = Progress('Выгружено')
+    f = open_file(path, 'w')
+    try:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_FIELDS)
+        layout = (len(store),)
+        for db in store.databases:
+            cursor = db.connection().execute(f'SELECT {", ".join(FIELDS)} FROM reminders ORDER BY id')
+            while True:
+                chunk = [row + layout for row in cursor.fetchmany(FETCH_SIZE)]
+                if not chunk:
+                    break
+                if fmt == 'csv':
+                    writer.writerows(chunk)
+                else:
+                    f.writelines(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + '\n' for row in chunk)
+                progress.add(len(chunk))
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    progress.done()
+    return progress.total
+
+# Пачка вставляется одной транзакцией; если она упала на ограничении
+# (например, повторный id с --keep-ids), та же пачка идет построчно,
+# и отвергнутые строки пропускаются. Возвращает число пропущенных
+def insert_rows(db, sql, rows):
+    try:
+        with db.transaction() as conn:
+            conn.executemany(sql, rows)
+        return 0
+    except sqlite3.IntegrityError:
+        pass
+    failed = 0
+    with db.transaction() as conn:
+        for row in rows:
+            try:
+                conn.execute(sql, row)
+            except sqlite3.IntegrityError as e:
+                failed += 1
+                print(f'\nСтрока {row} пропущена: {e}', file=sys.stderr)
+    return failed
+
+# С --keep-ids id из разных шардов источника столкнулись бы в одном шарде
+# назначения. Безопасно, если источник был одним файлом или раскладка та же
+# (chat_id % N дает те же шарды); выгрузки без поля shards — из одного файла
+def layout_matches(record, store):
+    shards = int(record.get('shards') or 1)
+    return shards == 1 or shards == len(store)
+
+def import_reminders(store, path, fmt, keep_ids=False, timezone=schema.DEFAULT_TIMEZONE):
+    tz = pytz.timezone(timezone)
+    columns = ['chat_id', 'username', 'text', 'time', 'next_time', 'time_ts', 'next_ts',
+               'repeat_interval', 'is_active']
+    if keep_ids:
+        columns.insert(0, 'id')
+    sql = (f'INSERT INTO reminders({", ".join(columns)}) '
+           f'VALUES ({", ".join("?" * len(columns))})')
+
+    progress = Progress('Загружено')
+    errors = 0
+    f = open_file(path, 'r')
+    try:
+        records = enumerate(iter_records(f, fmt), 1)
+        while True:
+            chunk = []
+            for number, record in islice(records, CHUNK_SIZE):
+                if keep_ids and not layout_matches(record, store):
+                    print(f'\nЗапись {number} выгружена из {record["shards"]} шардов, а загрузка идет в '
+                          f'{len(store)}: id повторятся, загрузите файл без --keep-ids', file=sys.stderr)
+                    return None
+                try:
+                    chunk.append(to_params(record, tz, keep_ids))
+                except (KeyError, ValueError, TypeError) as e:
+                    errors += 1
+                    print(f'\nЗапись {number} пропущена: {e!r}', file=sys.stderr)
+            if not chunk:
+                break
+            chat_index = 1 if keep_ids else 0
+            for shard, db in enumerate(store.databases):
+                rows = [row for row in chunk if store.shard(row[chat_index]) == shard]
+                if rows:
+                    errors += insert_rows(db, sql, rows)
+            progress.add(len(chunk))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    progress.done()
+    if errors:
+        print(f'Пропущено записей с ошибками: {errors}', file=sys.stderr)
+    return progress.total
+
+def main():
+    parser = argparse.ArgumentParser(description='Выгрузка и загрузка напоминаний (JSONL/CSV)')
+    parser.add_argument('--db', default='reminders.db')
+    parser.add_argument('--shards', type=int, default=1, help='число шардов базы')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help='выгрузить все напоминания')
+    export.add_argument('path')
+    export.add_argument('--format', choices=['jsonl', 'csv'])
+
+    load = subparsers.add_parser('import', help='загрузить напоминания из файла')
+    load.add_argument('path')
+    load.add_argument('--format', choices=['jsonl', 'csv'])
+    load.add_argument('--keep-ids', action='store_true', help='сохранить id из файла')
+    load.add_argument('--timezone', default=schema.DEFAULT_TIMEZONE,
+                      help='пояс для текстовых полей time/next_time')
+
+    args = parser.parse_args()
+    paths = storage.shard_paths(args.db, args.shards)
+    # sqlite3.connect создает недостающий файл — и выгрузка, и загрузка
+    # только наплодили бы пустых баз без схемы
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        print(f'Нет файлов базы: {", ".join(missing)}', file=sys.stderr)
+        return 1
+    store = storage.ShardedStore(paths)
+    try:
+        for db in store.databases:
+            if 'next_ts' not in schema.get_columns(db.connection(), 'reminders'):
+                print(f'База {db.path} не подготовлена: запустите бота или python schema.py migrate',
+                      file=sys.stderr)
+                return 1
+        fmt = detect_format(args.path, args.format)
+        if args.command == 'export':
+            export_reminders(store, args.path, fmt)
+        else:
+            if import_reminders(store, args.path, fmt, args.keep_ids, args.timezone) is None:
+                return 1
+            # Работающий бот увидит новые строки при ближайшей пересинхронизации планировщика
+            print('Запущенный бот подхватит напоминания при следующей пересинхронизации', file=sys.stderr)
+        return 0
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
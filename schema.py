@@ -0,0 +1,555 @@
+import argparse
+import sqlite3
+import sys
+import time
+from datetime import datetime
+import pytz
+
+# Схема таблицы напоминаний и онлайн-миграции.
+# Запуск: python schema.py migrate [--db reminders.db]
+#         python schema.py status [--db reminders.db]
+#         python schema.py migrate-epoch [--db reminders.db]
+#         python schema.py check-plans [--db reminders.db]
+#         python schema.py archive [--db reminders.db] [--days 30]
+#         python schema.py enable-incremental-vacuum [--db reminders.db]
+
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+LEGACY_TIME_FORMAT = "%Y-%m-%d %H:%M"
+SLICE_SECONDS = 0.2  # целевая длительность одной транзакции долгой миграции
+
+# Горячие запросы. Бот выполняет именно эти тексты, а check_query_plans
+# следит, чтобы ни один из них не превратился в полный просмотр таблицы
+SQL_CLAIM_DUE = """UPDATE reminders SET claimed_by = ?, lease_until = ?
+               WHERE id IN (
+                   SELECT id FROM reminders
+                   WHERE is_active = 1 AND next_ts <= ?
+                     AND (lease_until IS NULL OR lease_until <= ?)
+                   ORDER BY next_ts
+                   LIMIT ?)
+               RETURNING id, chat_id, text, repeat_interval, next_ts, time_ts"""
+SQL_LOAD_ACTIVE = 'SELECT id, next_ts FROM reminders WHERE is_active = 1'
+SQL_ACTIVE_NEXT_TS = 'SELECT next_ts FROM reminders WHERE id = ? AND is_active = 1'
+# Ближайшее незахваченное напоминание: так процесс без своей кучи узнает
+# о строках, созданных другими процессами
+SQL_NEXT_UNLEASED = '''SELECT id, next_ts FROM reminders
+               WHERE is_active = 1 AND (lease_until IS NULL OR lease_until <= ?)
+               ORDER BY next_ts LIMIT 1'''
+# Активные строки без next_ts: их пишут старые версии бота и draft.py
+SQL_TEXT_ONLY_ACTIVE = 'SELECT 1 FROM reminders WHERE is_active = 1 AND next_ts IS NULL LIMIT 1'
+SQL_COUNT_DUE = 'SELECT COUNT(*) FROM reminders WHERE is_active = 1 AND next_ts <= ?'
+# Список чата постранично по ключу (next_ts, id): каждая страница — поиск
+# по idx_chat_next от курсора, без OFFSET и без чтения предыдущих страниц
+SQL_CHAT_PAGE = '''SELECT id, next_ts, text, repeat_interval 
+               FROM reminders 
+               WHERE chat_id = ? AND is_active = 1 AND (next_ts, id) > (?, ?)
+               ORDER BY next_ts, id
+               LIMIT ?'''
+SQL_CHAT_PAGE_BEFORE = '''SELECT id, next_ts, text, repeat_interval 
+               FROM reminders 
+               WHERE chat_id = ? AND is_active = 1 AND (next_ts, id) < (?, ?)
+               ORDER BY next_ts DESC, id DESC
+               LIMIT ?'''
+# Пачка неактивных строк старше срока хранения: удаляется из горячей таблицы
+# и возвращается целиком, чтобы в той же транзакции лечь в архив
+SQL_ARCHIVE_BATCH = '''DELETE FROM reminders
+               WHERE id IN (
+                   SELECT id FROM reminders
+                   WHERE is_active = 0 AND next_ts < ?
+                   ORDER BY next_ts
+                   LIMIT ?)
+               RETURNING id, chat_id, username, text, time, repeat_interval,
+                         next_time, time_ts, next_ts'''
+SQL_CHAT_AGENDA = 'SELECT active_count, next_ts, next_id FROM chat_agenda WHERE chat_id = ?'
+
+# Поминутная статистика доставки: lag_i — число доставок с опозданием до
+# LAG_BUCKETS[i] сек, последний столбец — дольше. Столбцы создает миграция,
+# поэтому границы меняются только вместе с новой миграцией
+LAG_BUCKETS = (0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+LAG_COLUMNS = [f'lag_{i}' for i in range(len(LAG_BUCKETS) + 1)]
+SQL_DELIVERY_STATS_UPSERT = (
+    f'INSERT INTO delivery_stats(minute, sent, failed, send_seconds, {", ".join(LAG_COLUMNS)}) '
+    f'VALUES ({", ".join("?" * (len(LAG_COLUMNS) + 4))}) '
+    'ON CONFLICT(minute) DO UPDATE SET '
+    + ', '.join(f'{column} = {column} + excluded.{column}'
+                for column in ['sent', 'failed', 'send_seconds'] + LAG_COLUMNS)
+)
+SQL_DELIVERY_STATS_WINDOW = (
+    f'SELECT total(sent), total(failed), total(send_seconds), '
+    f'{", ".join(f"total({column})" for column in LAG_COLUMNS)} '
+    'FROM delivery_stats WHERE minute >= ?'
+)
+
+HOT_QUERIES = {
+    'claim_due': SQL_CLAIM_DUE,
+    'load_active': SQL_LOAD_ACTIVE,
+    'active_next_ts': SQL_ACTIVE_NEXT_TS,
+    'next_unleased': SQL_NEXT_UNLEASED,
+    'count_due': SQL_COUNT_DUE,
+    'text_only_active': SQL_TEXT_ONLY_ACTIVE,
+    'chat_page': SQL_CHAT_PAGE,
+    'chat_page_before': SQL_CHAT_PAGE_BEFORE,
+    'archive_batch': SQL_ARCHIVE_BATCH,
+    'chat_agenda': SQL_CHAT_AGENDA,
+    'delivery_stats_window': SQL_DELIVERY_STATS_WINDOW,
+}
+
+def get_columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+def create_reminders(conn):
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            text TEXT NOT NULL,
+            time TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT 1,
+            repeat_interval TEXT,
+            next_time TEXT NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_id ON reminders(chat_id)')
+
+# Проверка столбцов и ALTER идут под одной блокировкой записи (BEGIN IMMEDIATE):
+# иначе два процесса, мигрирующие одну базу, оба увидели бы, что столбца нет,
+# и второй упал бы на "duplicate column name"
+def add_columns(conn, columns):
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        existing = get_columns(conn, 'reminders')
+        for name, definition in columns:
+            if name not in existing:
+                conn.execute(f'ALTER TABLE reminders ADD COLUMN {name} {definition}')
+
+# Таблица, созданная draft.py, не имеет столбца username
+def ensure_username_column(conn):
+    add_columns(conn, [('username', "TEXT NOT NULL DEFAULT ''")])
+
+# Аренда напоминаний: какой процесс забрал строку на отправку и до какого момента
+def ensure_lease_columns(conn):
+    add_columns(conn, [('claimed_by', 'TEXT'), ('lease_until', 'INTEGER')])
+
+# Время напоминаний хранится как целые секунды UTC (time_ts, next_ts);
+# текстовые time/next_time остаются для совместимости со старыми версиями
+def ensure_epoch_columns(conn):
+    add_columns(conn, [('time_ts', 'INTEGER'), ('next_ts', 'INTEGER')])
+
+# Настройки чата; пока только часовой пояс (имя из базы IANA)
+def ensure_chat_settings(conn):
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            timezone TEXT NOT NULL
+        )
+        ''')
+
+# Журнал неудачных отправок: число попыток, время следующей попытки и класс ошибки.
+# status = 'retry' — ждет повтора, 'dead' — отправка прекращена (dead letter)
+def ensure_outbox(conn):
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            reminder_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt_at INTEGER,
+            error_class TEXT NOT NULL,
+            last_error TEXT,
+            status TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        ''')
+
+# Состояния диалогов (state_storage.StateTTLStorage); data — JSON
+def ensure_bot_states(conn):
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_states_expires ON bot_states(expires_at)')
+
+# Архив отработавших напоминаний: те же поля плюс время переноса
+def ensure_archive(conn):
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS reminders_archive (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            text TEXT NOT NULL,
+            time TEXT NOT NULL,
+            repeat_interval TEXT,
+            next_time TEXT NOT NULL,
+            time_ts INTEGER,
+            next_ts INTEGER,
+            archived_at INTEGER NOT NULL
+        )
+        ''')
+
+# Частичные индексы строятся последней миграцией, когда данные уже заполнены.
+# CREATE INDEX в SQLite — одна инструкция, поделить ее на части нельзя: на время
+# построения запись в базу ждет. На больших базах запускайте `schema.py migrate`
+# до выкладки, тогда бот при старте найдет индексы готовыми.
+# idx_due покрывает выборку сработавших напоминаний
+# (is_active в ключе нужен, чтобы индекс был покрывающим), idx_chat_next отдает
+# список чата сразу в порядке next_ts, idx_inactive — очередь на архивацию.
+# idx_active по булеву столбцу и индексы по next_time/next_ts ими заменены
+def ensure_indexes(conn):
+    with conn:
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_due '
+            'ON reminders(next_ts, lease_until, is_active) WHERE is_active = 1'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_chat_next '
+            'ON reminders(chat_id, next_ts) WHERE is_active = 1'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_inactive '
+            'ON reminders(next_ts) WHERE is_active = 0'
+        )
+        for name in ('idx_active', 'idx_next_time', 'idx_next_ts'):
+            conn.execute(f'DROP INDEX IF EXISTS {name}')
+
+def explain(conn, sql):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, (None,) * sql.count('?'))]
+
+# Допустим только поиск по индексу или просмотр покрывающего индекса;
+# просмотр таблицы и временное B-дерево для сортировки считаются регрессией
+def check_query_plans(conn):
+    problems = []
+    for name, sql in HOT_QUERIES.items():
+        for detail in explain(conn, sql):
+            if 'USE TEMP B-TREE' in detail or (detail.startswith('SCAN') and 'COVERING INDEX' not in detail):
+                problems.append((name, detail))
+    return problems
+
+def to_epoch(value, tz):
+    return int(tz.localize(datetime.strptime(value, LEGACY_TIME_FORMAT)).timestamp())
+
+# Переписывает строки пачками по возрастанию id, каждая пачка — своя короткая
+# транзакция. Размер пачки подстраивается так, чтобы транзакция длилась около
+# slice_seconds: работающий бот не ждет блокировку дольше одной пачки.
+# Прерванный проход безопасно продолжается: берутся только строки с next_ts IS NULL
+def iter_backfill_epoch(conn, timezone=DEFAULT_TIMEZONE, batch_size=1000, slice_seconds=SLICE_SECONDS):
+    tz = pytz.timezone(timezone)
+    total = 0
+    last_id = 0
+    while True:
+        started = time.monotonic()
+        rows = conn.execute(
+            'SELECT id, time, next_time FROM reminders WHERE id > ? AND next_ts IS NULL ORDER BY id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+
+        with conn:
+            conn.executemany(
+                'UPDATE reminders SET time_ts = ?, next_ts = ? WHERE id = ? AND next_ts IS NULL',
+                [(to_epoch(time_str, tz), to_epoch(next_str, tz), rem_id)
+                 for rem_id, time_str, next_str in rows]
+            )
+        total += len(rows)
+        last_id = rows[-1][0]
+        yield total
+        if len(rows) < batch_size:
+            return
+
+        elapsed = time.monotonic() - started
+        if elapsed < slice_seconds / 2:
+            batch_size *= 2
+        elif elapsed > slice_seconds:
+            batch_size = max(100, batch_size // 2)
+
+# Миграция 5 проходит один раз, а строки только с текстовым временем могут
+# появляться и после нее (старый бот во время выкатки, draft.py). Без next_ts
+# их не видит ни планировщик, ни список, поэтому бот дописывает их при старте
+# и на пересинхронизации. Пока таких строк нет, это один поиск по idx_due
+def backfill_text_only(conn, timezone=DEFAULT_TIMEZONE):
+    if conn.execute(SQL_TEXT_ONLY_ACTIVE).fetchone() is None:
+        return 0
+    total = 0
+    for total in iter_backfill_epoch(conn, timezone):
+        pass
+    return total
+
+def backfill_epoch(conn, timezone=DEFAULT_TIMEZONE, batch_size=1000, pause=0.05, progress=None):
+    total = 0
+    for total in iter_backfill_epoch(conn, timezone, batch_size):
+        if progress:
+            progress(total)
+        time.sleep(pause)
+    return total
+
+# Сводка по чату: число активных напоминаний и ближайшее из них. Ее ведут
+# триггеры в той же транзакции, что и запись в reminders: счетчик меняется
+# на разницу, ближайшее берется одним поиском по idx_chat_next.
+# Аренда (claimed_by, lease_until) триггеры не задевает
+AGENDA_UPSERT = '''
+    INSERT INTO chat_agenda(chat_id, active_count, next_ts, next_id)
+    VALUES ({chat}, {delta},
+        (SELECT next_ts FROM reminders WHERE chat_id = {chat} AND is_active = 1
+         ORDER BY next_ts, id LIMIT 1),
+        (SELECT id FROM reminders WHERE chat_id = {chat} AND is_active = 1
+         ORDER BY next_ts, id LIMIT 1))
+    ON CONFLICT(chat_id) DO UPDATE SET
+        active_count = active_count + excluded.active_count,
+        next_ts = excluded.next_ts,
+        next_id = excluded.next_id;
+    DELETE FROM chat_agenda WHERE chat_id = {chat} AND active_count <= 0;'''
+
+def ensure_chat_agenda(conn, batch_size=500):
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_agenda (
+            chat_id INTEGER PRIMARY KEY,
+            active_count INTEGER NOT NULL,
+            next_ts INTEGER,
+            next_id INTEGER
+        )
+        ''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS agenda_insert AFTER INSERT ON reminders
+        WHEN NEW.is_active = 1
+        BEGIN {AGENDA_UPSERT.format(chat='NEW.chat_id', delta=1)}
+        END''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS agenda_delete AFTER DELETE ON reminders
+        WHEN OLD.is_active = 1
+        BEGIN {AGENDA_UPSERT.format(chat='OLD.chat_id', delta=-1)}
+        END''')
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS agenda_update AFTER UPDATE OF chat_id, is_active, next_ts ON reminders
+        WHEN OLD.is_active = 1 OR NEW.is_active = 1
+        BEGIN
+            {AGENDA_UPSERT.format(chat='OLD.chat_id', delta='-(OLD.is_active = 1)')}
+            {AGENDA_UPSERT.format(chat='NEW.chat_id', delta='(NEW.is_active = 1)')}
+        END''')
+    return iter_rebuild_agenda(conn, batch_size)
+
+# Заполнение сводки для уже существующих строк пачками чатов. Триггеры уже
+# работают, а пересчет берет значения прямо из reminders, поэтому одновременные
+# записи бота ничего не портят
+def iter_rebuild_agenda(conn, batch_size=500):
+    total = 0
+    last_chat = None
+    while True:
+        chats = [row[0] for row in conn.execute(
+            'SELECT DISTINCT chat_id FROM reminders WHERE is_active = 1 AND chat_id > ? '
+            'ORDER BY chat_id LIMIT ?',
+            (-2 ** 63 if last_chat is None else last_chat, batch_size)
+        )]
+        if not chats:
+            return
+        with conn:
+            conn.executemany(
+                '''INSERT OR REPLACE INTO chat_agenda(chat_id, active_count, next_ts, next_id)
+                   SELECT ?1, count(*),
+                       (SELECT next_ts FROM reminders WHERE chat_id = ?1 AND is_active = 1
+                        ORDER BY next_ts, id LIMIT 1),
+                       (SELECT id FROM reminders WHERE chat_id = ?1 AND is_active = 1
+                        ORDER BY next_ts, id LIMIT 1)
+                   FROM reminders WHERE chat_id = ?1 AND is_active = 1''',
+                [(chat_id,) for chat_id in chats]
+            )
+        total += len(chats)
+        last_chat = chats[-1]
+        yield total
+        if len(chats) < batch_size:
+            return
+
+# Одна строка на минуту (начало минуты, epoch); строки складываются UPSERT-ом,
+# окно в час или сутки — сумма 60 или 1440 строк по первичному ключу
+def ensure_delivery_stats(conn):
+    with conn:
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS delivery_stats (
+            minute INTEGER PRIMARY KEY,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            send_seconds REAL NOT NULL DEFAULT 0,
+            {", ".join(f"{column} INTEGER NOT NULL DEFAULT 0" for column in LAG_COLUMNS)}
+        )
+        ''')
+
+# Переносит неактивные строки с next_ts раньше before_ts в архив короткими
+# транзакциями по batch_size строк, как backfill_epoch
+def archive_inactive(conn, before_ts, batch_size=500, pause=0.05, progress=None):
+    total = 0
+    while True:
+        with conn:
+            rows = conn.execute(SQL_ARCHIVE_BATCH, (before_ts, batch_size)).fetchall()
+            archived_at = int(time.time())
+            conn.executemany(
+                '''INSERT OR REPLACE INTO reminders_archive(id, chat_id, username, text, time,
+                       repeat_interval, next_time, time_ts, next_ts, archived_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                [row + (archived_at,) for row in rows]
+            )
+        total += len(rows)
+        if progress and rows:
+            progress(total)
+        if len(rows) < batch_size:
+            return total
+        time.sleep(pause)
+
+# Освобожденные страницы возвращаются файлу только в режиме auto_vacuum=INCREMENTAL
+# (новые базы создаются в нем, старые переводятся один раз полным VACUUM,
+# см. enable-incremental-vacuum).
+# Страницы отдаются порциями, чтобы не держать блокировку записи долго
+def incremental_vacuum(conn, pages=1000, pause=0.05):
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return None
+    freed = 0
+    while True:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            return freed
+        # execute() делает только один шаг прагмы (одну страницу), executescript — все
+        conn.executescript(f'PRAGMA incremental_vacuum({min(free, pages)})')
+        freed += min(free, pages)
+        time.sleep(pause)
+
+# Версионные миграции. Шаг — функция от соединения; долгий шаг возвращает
+# генератор, каждый next() которого — одна закоммиченная пачка, между пачками
+# раннер делает паузу. Шаги идемпотентны: база, созданная до schema_version,
+# проходит их все и получает отметки о версиях
+MIGRATIONS = [
+    (1, 'reminders', create_reminders),
+    (2, 'username column', ensure_username_column),
+    (3, 'lease columns', ensure_lease_columns),
+    (4, 'epoch columns', ensure_epoch_columns),
+    (5, 'epoch backfill', iter_backfill_epoch),
+    (6, 'chat settings', ensure_chat_settings),
+    (7, 'outbox', ensure_outbox),
+    (8, 'archive', ensure_archive),
+    (9, 'bot states', ensure_bot_states),
+    (10, 'partial indexes', ensure_indexes),
+    (11, 'chat agenda', ensure_chat_agenda),
+    (12, 'delivery stats', ensure_delivery_stats),
+]
+
+# auto_vacuum можно выбрать только до создания первой таблицы, а первой
+# создается schema_version — поэтому новая база получает INCREMENTAL здесь,
+# еще до миграции 1 (соединения бота делают это раньше, в storage, до WAL).
+# Существующим базам нужен enable-incremental-vacuum
+def ensure_schema_version(conn):
+    if not conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone():
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at INTEGER NOT NULL
+        )
+        ''')
+
+def applied_versions(conn):
+    ensure_schema_version(conn)
+    return {row[0] for row in conn.execute('SELECT version FROM schema_version')}
+
+def migrate(conn, pause=0.05, progress=None):
+    applied = applied_versions(conn)
+    done = []
+    for version, name, step in MIGRATIONS:
+        if version in applied:
+            continue
+        started = time.time()
+        batches = step(conn)
+        if batches is not None:
+            for total in batches:
+                if progress:
+                    progress(version, name, total)
+                time.sleep(pause)
+        with conn:
+            # OR IGNORE: два процесса могли пройти один и тот же шаг одновременно
+            conn.execute(
+                'INSERT OR IGNORE INTO schema_version(version, name, applied_at) VALUES (?, ?, ?)',
+                (version, name, int(time.time()))
+            )
+        done.append((version, name, time.time() - started))
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description='Миграции базы напоминаний')
+    parser.add_argument('--db', default='reminders.db')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    epoch = subparsers.add_parser('migrate-epoch', help='заполнить time_ts/next_ts из текстовых полей')
+    epoch.add_argument('--timezone', default=DEFAULT_TIMEZONE)
+    epoch.add_argument('--batch-size', type=int, default=1000)
+    epoch.add_argument('--pause', type=float, default=0.05, help='пауза между пачками, сек')
+
+    subparsers.add_parser('migrate', help='применить все новые миграции')
+    subparsers.add_parser('status', help='показать примененные миграции')
+    subparsers.add_parser('check-plans', help='проверить планы горячих запросов')
+
+    archive = subparsers.add_parser('archive', help='перенести старые неактивные напоминания в архив')
+    archive.add_argument('--days', type=int, default=30, help='срок хранения в горячей таблице, дней')
+    archive.add_argument('--batch-size', type=int, default=500)
+    archive.add_argument('--pause', type=float, default=0.05, help='пауза между пачками, сек')
+
+    subparsers.add_parser('enable-incremental-vacuum',
+                          help='включить auto_vacuum=INCREMENTAL (полный VACUUM, бот лучше остановить)')
+
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        if args.command == 'migrate':
+            done = migrate(conn, progress=lambda version, name, n: print(
+                f'\r{version} {name}: {n}', end='', flush=True))
+            for version, name, elapsed in done:
+                print(f'\nПрименена миграция {version} ({name}) за {elapsed:.1f} с', end='')
+            print(f'\nТекущая версия: {max(applied_versions(conn))}')
+        elif args.command == 'status':
+            applied = applied_versions(conn)
+            for version, name, step in MIGRATIONS:
+                print(f'{version:3} {"+" if version in applied else "-"} {name}')
+        elif args.command == 'migrate-epoch':
+            ensure_epoch_columns(conn)
+            started = time.time()
+            total = backfill_epoch(
+                conn, args.timezone, args.batch_size, args.pause,
+                progress=lambda n: print(f'\rОбновлено строк: {n}', end='', flush=True)
+            )
+            print(f'\nГотово: {total} строк за {time.time() - started:.1f} с')
+        elif args.command == 'check-plans':
+            for name, sql in HOT_QUERIES.items():
+                print(f'{name}: {"; ".join(explain(conn, sql))}')
+            problems = check_query_plans(conn)
+            for name, detail in problems:
+                print(f'РЕГРЕССИЯ {name}: {detail}')
+            return 1 if problems else 0
+        elif args.command == 'archive':
+            ensure_archive(conn)
+            ensure_indexes(conn)
+            started = time.time()
+            total = archive_inactive(
+                conn, int(time.time()) - args.days * 86400, args.batch_size, args.pause,
+                progress=lambda n: print(f'\rПеренесено строк: {n}', end='', flush=True)
+            )
+            freed = incremental_vacuum(conn)
+            print(f'\nГотово: {total} строк за {time.time() - started:.1f} с')
+            if freed is None:
+                print('auto_vacuum не INCREMENTAL, место в файле не освобождено')
+            else:
+                print(f'Освобождено страниц: {freed}')
+        elif args.command == 'enable-incremental-vacuum':
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            print(f'auto_vacuum = {conn.execute("PRAGMA auto_vacuum").fetchone()[0]}')
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
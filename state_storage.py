@@ -0,0 +1,199 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from telebot.storage import StateStorageBase
+from telebot.storage.base_storage import StateDataContext
+
+# Хранилище состояний диалогов для telebot (bot.set_state/get_state/add_data).
+# В памяти держится не больше maxsize записей (LRU), каждая живет ttl секунд
+# с последнего изменения. Если передана очередь записи storage.WriteQueue,
+# состояния дублируются в таблицу bot_states шарда чата и переживают перезапуск,
+# а вытесненные из памяти записи подгружаются оттуда при следующем обращении.
+# Запись в базу не ждет коммита, поэтому промах памяти сначала дожидается
+# еще не примененной записи этого ключа (_pending) — иначе только что
+# удаленное состояние прочиталось бы из базы снова. В _pending лежат только
+# незавершенные операции, память ограничена maxsize и очередью записи
+
+STATE_TTL = 3600  # сек, после этого брошенный диалог забывается
+STATE_CACHE_SIZE = 10000
+
+class StateTTLStorage(StateStorageBase):
+    # store — storage.ShardedStore: состояние пишется в шард своего чата,
+    # поэтому записи диалогов распределяются по писателям всех шардов
+    def __init__(self, store=None, ttl=STATE_TTL, maxsize=STATE_CACHE_SIZE,
+                 prefix='telebot', separator=':'):
+        super().__init__()
+        self.store = store
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.prefix = prefix
+        self.separator = separator
+        self._entries = OrderedDict()  # ключ -> [expires_at, state, data]
+        self._lock = threading.Lock()
+        self._pending = {}  # ключ -> future последней еще не примененной записи
+        # Отдельная блокировка: колбэк future выполняется в потоке-писателе,
+        # а под _lock можно ждать этого писателя
+        self._pending_lock = threading.Lock()
+
+    def _key(self, chat_id, user_id, business_connection_id, message_thread_id, bot_id):
+        return self._get_key(chat_id, user_id, self.prefix, self.separator,
+                             business_connection_id, message_thread_id, bot_id)
+
+    def _write(self, key, chat_id, sql, params):
+        future = self.store.writes(chat_id).execute(sql, params)
+        with self._pending_lock:
+            self._pending[key] = future
+        future.add_done_callback(lambda done: self._written(key, done))
+
+    def _written(self, key, future):
+        with self._pending_lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def _load(self, key, chat_id):
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self.store is not None:
+            with self._pending_lock:
+                pending = self._pending.get(key)
+            if pending is not None:
+                try:
+                    pending.result()
+                except Exception:
+                    pass
+            row = self.store.db(chat_id).query_one(
+                'SELECT expires_at, state, data FROM bot_states WHERE key = ?', (key,)
+            )
+            if row:
+                entry = [row[0], row[1], json.loads(row[2])]
+                self._remember(key, entry)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            self._forget(key, chat_id)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key, chat_id):
+        self._entries.pop(key, None)
+        if self.store is not None:
+            self._write(key, chat_id, 'DELETE FROM bot_states WHERE key = ?', (key,))
+
+    # Запись в БД не ждет коммита: очередь одна и выполняет операции по порядку
+    def _store(self, key, chat_id, entry):
+        entry[0] = time.time() + self.ttl
+        self._remember(key, entry)
+        if self.store is not None:
+            self._write(
+                key,
+                chat_id,
+                '''INSERT INTO bot_states(key, state, data, expires_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET
+                       state = excluded.state,
+                       data = excluded.data,
+                       expires_at = excluded.expires_at''',
+                (key, entry[1], json.dumps(entry[2], ensure_ascii=False), entry[0])
+            )
+
+    def set_state(self, chat_id, user_id, state,
+                  business_connection_id=None, message_thread_id=None, bot_id=None):
+        if hasattr(state, 'name'):
+            state = state.name
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._lock:
+            entry = self._load(key, chat_id) or [0, None, {}]
+            entry[1] = state
+            self._store(key, chat_id, entry)
+        return True
+
+    def get_state(self, chat_id, user_id,
+                  business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._lock:
+            entry = self._load(key, chat_id)
+            return entry[1] if entry else None
+
+    def delete_state(self, chat_id, user_id,
+                     business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._lock:
+            if self._load(key, chat_id) is None:
+                return False
+            self._forget(key, chat_id)
+            return True
+
+    def set_data(self, chat_id, user_id, key, value,
+                 business_connection_id=None, message_thread_id=None, bot_id=None):
+        state_key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._lock:
+            entry = self._load(state_key, chat_id)
+            if entry is None:
+                raise RuntimeError(f"StateTTLStorage: key {state_key} does not exist.")
+            entry[2] = dict(entry[2], **{key: value})
+            self._store(state_key, chat_id, entry)
+        return True
+
+    def get_data(self, chat_id, user_id,
+                 business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._lock:
+            entry = self._load(key, chat_id)
+            return dict(entry[2]) if entry else {}
+
+    def reset_data(self, chat_id, user_id,
+                   business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._lock:
+            entry = self._load(key, chat_id)
+            if entry is None:
+                return False
+            entry[2] = {}
+            self._store(key, chat_id, entry)
+            return True
+
+    def get_interactive_data(self, chat_id, user_id,
+                             business_connection_id=None, message_thread_id=None, bot_id=None):
+        return StateDataContext(
+            self,
+            chat_id=chat_id,
+            user_id=user_id,
+            business_connection_id=business_connection_id,
+            message_thread_id=message_thread_id,
+            bot_id=bot_id,
+        )
+
+    def save(self, chat_id, user_id, data,
+             business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        with self._lock:
+            entry = self._load(key, chat_id)
+            if entry is None:
+                return False
+            # retrieve_data() сохраняет данные и при простом чтении — лишнюю запись пропускаем
+            if entry[2] != data:
+                entry[2] = dict(data)
+                self._store(key, chat_id, entry)
+            return True
+
+    # Истекшие записи в памяти вытесняет LRU, в таблице их удаляет этот метод
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] <= now]:
+                del self._entries[key]
+        if self.store is not None:
+            futures = [writes.execute('DELETE FROM bot_states WHERE expires_at <= ?', (now,))
+                       for writes in self.store.writers]
+            return sum(future.result()[1] for future in futures)
+        return 0
+
+    def __str__(self):
+        return f"<StateTTLStorage: {len(self._entries)} in memory>"
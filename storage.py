@@ -0,0 +1,175 @@
+import sqlite3
+import threading
+import time
+import queue
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+# Доступ к SQLite для бота. У каждого потока свое соединение в режиме WAL:
+# чтения из обработчиков не ждут записи планировщика, а курсоры и lastrowid
+# разных потоков больше не перемешиваются.
+# Запись — только внутри db.transaction(), чтение — через db.query()/db.query_one().
+
+BUSY_TIMEOUT = 10  # сек ожидания чужой блокировки записи
+FLUSH_INTERVAL = 0.002  # сек, сколько писатель копит операции после первой
+FLUSH_BATCH = 200  # операций в одной транзакции, не больше
+
+class Database:
+    def __init__(self, path, busy_timeout=BUSY_TIMEOUT):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            # Новая база создается с auto_vacuum=INCREMENTAL (см. schema.incremental_vacuum).
+            # Переход в WAL записывает заголовок файла, после этого режим уже не сменить
+            if not conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone():
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    # BEGIN IMMEDIATE берет блокировку записи сразу, а не при первом UPDATE,
+    # поэтому транзакция не падает с SQLITE_BUSY посередине
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchone()
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+# Групповая запись: операции из всех обработчиков собирает один поток-писатель
+# и применяет их одной транзакцией раз в FLUSH_INTERVAL или по FLUSH_BATCH штук.
+# Каждая операция — функция от соединения, выполняется в своем SAVEPOINT:
+# ошибка одной откатывает только ее. Future вызывающего получает результат
+# функции (например, lastrowid) только после коммита всей пачки
+class WriteQueue:
+    def __init__(self, db, interval=FLUSH_INTERVAL, batch_size=FLUSH_BATCH):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, operation):
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def execute(self, sql, params=()):
+        return self.submit(lambda conn: conn.execute(sql, params))
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _flush(self, batch):
+        results = []
+        try:
+            with self.db.transaction() as conn:
+                for operation, future in batch:
+                    conn.execute('SAVEPOINT op')
+                    try:
+                        result = operation(conn)
+                        # курсор после коммита не пригоден, отдаем его числа
+                        if isinstance(result, sqlite3.Cursor):
+                            result = (result.lastrowid, result.rowcount)
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO op')
+                        results.append((future, None, e))
+                    else:
+                        results.append((future, result, None))
+                    conn.execute('RELEASE op')
+        except Exception as e:
+            for operation, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._flush(self._collect(item))
+
+# Шардирование по chat_id: N файлов базы, у каждого свой поток-писатель, поэтому
+# записи разных шардов не ждут друг друга. Все данные чата лежат в одном шарде;
+# id напоминаний уникальны только внутри шарда
+def shard_paths(path, count):
+    if count == 1:
+        return [path]
+    stem, dot, ext = path.rpartition('.')
+    return [f'{stem}.{i}.{ext}' if dot else f'{path}.{i}' for i in range(count)]
+
+class ShardedStore:
+    def __init__(self, paths, busy_timeout=BUSY_TIMEOUT):
+        self.databases = [Database(path, busy_timeout) for path in paths]
+        self.writers = [WriteQueue(db) for db in self.databases]
+
+    def __len__(self):
+        return len(self.databases)
+
+    def shard(self, chat_id):
+        return chat_id % len(self.databases)
+
+    def db(self, chat_id):
+        return self.databases[self.shard(chat_id)]
+
+    def writes(self, chat_id):
+        return self.writers[self.shard(chat_id)]
+
+    def close(self):
+        for writes in self.writers:
+            writes.stop()
+        for db in self.databases:
+            db.close()